@@ -0,0 +1,321 @@
+#!/usr/bin/env dials.python
+
+import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import inspect
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from file_packing import UploadBody
+from mock_zenodo import MockZenodo
+from zenodo_client import ZenodoClient
+from zenodo_updater import ZenodoUpdater
+from zenodo_uploader import ZenodoUploader
+
+
+class PhaseTimer(object):
+    """collect the wall time of every call to each named phase"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times = {}
+        self.failed = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.failed[name] = self.failed.get(name, 0) + 1
+            raise
+        with self._lock:
+            self.times.setdefault(name, []).append(time.time() - t0)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def timed(cls, timer, prefix, phases):
+    """subclass of uploader / updater cls with the methods named in phases
+    timed by timer, as prefix:phase"""
+
+    def wrap(name):
+        method = getattr(cls, name)
+        label = "%s:%s" % (prefix, name.lstrip("_"))
+
+        if inspect.iscoroutinefunction(method):
+
+            async def timed_coroutine(self, *args, **kwargs):
+                with timer.phase(label):
+                    return await method(self, *args, **kwargs)
+
+            return timed_coroutine
+
+        def timed_method(self, *args, **kwargs):
+            with timer.phase(label):
+                return method(self, *args, **kwargs)
+
+        return timed_method
+
+    return type("Timed%s" % cls.__name__, (cls,), {name: wrap(name) for name in phases})
+
+
+def make_files(directory, count, size):
+    """count files of size random bytes in directory"""
+
+    files = []
+    for j in range(count):
+        filename = os.path.join(directory, "data_%05d.bin" % j)
+        with open(filename, "wb") as f:
+            f.write(os.urandom(size))
+        files.append(filename)
+    return files
+
+
+def run_benchmark(
+    mock,
+    files,
+    depositions=10,
+    concurrency=4,
+    jobs=1,
+    checksum=False,
+    update=False,
+    pool_size=None,
+):
+    """deposit files depositions times against the mock, concurrency
+    depositions at once, then (if update) update the metadata of each -
+    return the PhaseTimer, the client and the wall time"""
+
+    timer = PhaseTimer()
+    client = ZenodoClient(
+        "benchmark",
+        server=mock.server,
+        pool_size=pool_size or max(10, concurrency * jobs),
+        backoff=0.1,
+    )
+    Uploader = timed(
+        ZenodoUploader,
+        timer,
+        "upload",
+        ("_find", "_create", "_update", "_upload", "_publish"),
+    )
+    Updater = timed(ZenodoUpdater, timer, "update", ("_find", "_update", "_publish"))
+
+    def deposit(j):
+        metadata = {
+            "title": "Benchmark deposition %d" % j,
+            "description": "benchmark",
+            "creators": [{"name": "Doe, John R.", "affiliation": "Nowhere"}],
+            "keywords": ["benchmark"],
+        }
+        # failures are counted by the timer, and should be rare unless
+        # errors are being injected into non-idempotent requests
+        try:
+            with timer.phase("deposition"):
+                Uploader(
+                    files,
+                    dict(metadata),
+                    None,
+                    jobs=jobs,
+                    client=client,
+                    checksum=checksum,
+                ).upload()
+            if update:
+                with timer.phase("update"):
+                    Updater(
+                        {"title": metadata["title"], "keywords": ["updated"]},
+                        None,
+                        client=client,
+                    ).update()
+        except RuntimeError as e:
+            print("Deposition %d failed: %s" % (j, e))
+
+    t0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(deposit, range(depositions)))
+    return timer, client, time.time() - t0
+
+
+def sendfile_put(url, filename):
+    """PUT filename to url with os.sendfile, so the kernel copies the file
+    straight to the socket - only possible over plain HTTP, so here as the
+    ceiling for what a single stream can do against the mock"""
+
+    url = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    size = os.path.getsize(filename)
+    try:
+        connection.putrequest("PUT", "%s?%s" % (url.path, url.query))
+        connection.putheader("Content-Length", str(size))
+        connection.endheaders()
+        with open(filename, "rb") as f:
+            offset = 0
+            while offset < size:
+                offset += os.sendfile(
+                    connection.sock.fileno(), f.fileno(), offset, size - offset
+                )
+        r = connection.getresponse()
+        r.read()
+        if r.status != 201:
+            raise RuntimeError("in sendfile: HTTP status %d" % r.status)
+    finally:
+        connection.close()
+
+
+def stream_benchmark(mock, filename, repeats=5):
+    """upload filename repeats times over one stream with each kind of
+    request body - return body: list of MB/s"""
+
+    client = ZenodoClient("benchmark", server=mock.server)
+    bucket = client.post("/api/deposit/depositions", "create", json={}).json()["links"][
+        "bucket"
+    ]
+    size = os.path.getsize(filename)
+
+    def put_file():
+        with open(filename, "rb") as f:
+            client.put("%s/file" % bucket, "upload", data=f)
+
+    def put_buffered():
+        with open(filename, "rb", buffering=0) as f:
+            client.put("%s/buffered" % bucket, "upload", data=UploadBody(f))
+
+    def put_sendfile():
+        sendfile_put("%s/sendfile?access_token=benchmark" % bucket, filename)
+
+    bodies = [("file", put_file), ("buffered", put_buffered)]
+    if hasattr(os, "sendfile") and mock.server.startswith("http:"):
+        bodies.append(("sendfile", put_sendfile))
+
+    rates = {}
+    for j in range(repeats):
+        for name, put in bodies:
+            t0 = time.time()
+            put()
+            rates.setdefault(name, []).append(size / 1.0e6 / (time.time() - t0))
+    client.close()
+    return rates
+
+
+def print_report(timer, client, wall, total_bytes, depositions):
+    print(
+        "%d depositions in %.2fs: %.2f depositions/s, %.1f MB/s"
+        % (depositions, wall, depositions / wall, total_bytes / 1.0e6 / wall)
+    )
+    print(
+        "%-20s %8s %8s %10s %10s" % ("phase", "calls", "failed", "p50 / ms", "p99 / ms")
+    )
+    for name in sorted(set(timer.times) | set(timer.failed)):
+        times = timer.times.get(name) or [float("nan")]
+        print(
+            "%-20s %8d %8d %10.1f %10.1f"
+            % (
+                name,
+                len(timer.times.get(name, [])),
+                timer.failed.get(name, 0),
+                1000 * percentile(times, 50),
+                1000 * percentile(times, 99),
+            )
+        )
+    client.report()
+
+
+def benchmark():
+    """main() - run the uploader (and updater) against a local mock Zenodo
+    and report throughput and per-phase latency"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--depositions", help="number of depositions", type=int, default=20
+    )
+    parser.add_argument(
+        "-f", "--files", help="files per deposition", type=int, default=5
+    )
+    parser.add_argument("--size", help="bytes per file", type=int, default=1000000)
+    parser.add_argument(
+        "-c", "--concurrency", help="depositions at once", type=int, default=4
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="file uploads at once per deposition", type=int, default=1
+    )
+    parser.add_argument(
+        "-x", "--checksum", help="verify checksums", action="store_true"
+    )
+    parser.add_argument(
+        "-u", "--update", help="also update each deposition", action="store_true"
+    )
+    parser.add_argument(
+        "--latency", help="mock server seconds per request", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--bandwidth", help="mock server upload bytes / second per stream", type=float
+    )
+    parser.add_argument(
+        "--error-rate",
+        help="fraction of requests the mock fails with 429 / 503",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--stream",
+        help="instead, time uploads of one file of --size bytes over a single "
+        "stream with each kind of request body, --files times",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.stream:
+        return stream_main(args)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = make_files(tmpdir, args.files, args.size)
+        with MockZenodo(
+            latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate
+        ) as mock:
+            timer, client, wall = run_benchmark(
+                mock,
+                files,
+                depositions=args.depositions,
+                concurrency=args.concurrency,
+                jobs=args.jobs,
+                checksum=args.checksum,
+                update=args.update,
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print_report(
+        timer, client, wall, args.depositions * args.files * args.size, args.depositions
+    )
+
+
+def stream_main(args):
+    """report MB/s per stream for each kind of upload body"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        (filename,) = make_files(tmpdir, 1, args.size)
+        with MockZenodo(latency=args.latency, bandwidth=args.bandwidth) as mock:
+            rates = stream_benchmark(mock, filename, repeats=args.files)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("%.1f MB over one stream, %d times" % (args.size / 1.0e6, args.files))
+    print("%-20s %10s %10s" % ("body", "p50 MB/s", "max MB/s"))
+    for name, values in rates.items():
+        print("%-20s %10.1f %10.1f" % (name, percentile(values, 50), max(values)))
+
+
+if __name__ == "__main__":
+    benchmark()
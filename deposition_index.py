@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+
+
+class DepositionIndex(object):
+    """local index of all the depositions in the account, paged from the API
+    in one pass and cached in filename for ttl seconds, so that lookups by
+    title, id or DOI do not each need a search query. Refreshes after the
+    first only fetch depositions modified since the newest one fetched by the
+    last - not counting those added here, as others may have been modified
+    on the server since."""
+
+    def __init__(self, client, filename=None, ttl=3600, page_size=100):
+        self._client = client
+        self._filename = filename
+        self._ttl = ttl
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self._updated = 0
+        self._fetched = None
+        self._depositions = {}
+
+        if filename and os.path.exists(filename):
+            with open(filename, "r") as f:
+                saved = json.load(f)
+            if saved.get("server") == client.server:
+                self._updated = saved["updated"]
+                self._fetched = saved.get("fetched")
+                self._depositions = {d["id"]: d for d in saved["depositions"]}
+
+        self._reindex()
+
+    def _reindex(self):
+        self._titles = {}
+        self._dois = {}
+        # only the latest published version of each record is found by title,
+        # as for a records search - drafts (e.g. an upload to be resumed, or
+        # a new version in progress) are not
+        latest = {}
+        for d in self._depositions.values():
+            if d.get("doi"):
+                self._dois[d["doi"]] = d
+            if not d["submitted"]:
+                continue
+            record = d.get("conceptrecid") or d["id"]
+            if record not in latest or d["id"] > latest[record]["id"]:
+                latest[record] = d
+        for d in latest.values():
+            self._titles.setdefault(d["title"], []).append(d)
+
+    def refresh(self, force=False):
+        """bring the index up to date if older than ttl, or if force - page
+        through depositions most recently modified first and stop on reaching
+        those already known"""
+
+        with self._lock:
+            if not force and time.time() - self._updated < self._ttl:
+                return
+
+            latest = self._fetched
+            started = time.time()
+            page = 1
+            count = 0
+            while True:
+                r = self._client.get(
+                    "/api/deposit/depositions",
+                    "index",
+                    params={
+                        "page": page,
+                        "size": self._page_size,
+                        "sort": "mostrecent",
+                    },
+                )
+                depositions = r.json()
+                for d in depositions:
+                    self._add(d)
+                    # the newest seen from the server, not from add()
+                    if self._fetched is None or d["modified"] > self._fetched:
+                        self._fetched = d["modified"]
+                count += len(depositions)
+                if len(depositions) < self._page_size:
+                    break
+                if latest and min(d["modified"] for d in depositions) < latest:
+                    break
+                page += 1
+
+            self._updated = started
+            self._reindex()
+            print("Indexed %d depositions (%d total)" % (count, len(self)))
+
+        self.save()
+
+    def _add(self, deposition):
+        self._depositions[deposition["id"]] = {
+            "id": deposition["id"],
+            "title": deposition.get("title", deposition["metadata"].get("title")),
+            "doi": deposition.get("doi"),
+            "modified": deposition["modified"],
+            "submitted": deposition.get("submitted", False),
+            "conceptrecid": deposition.get("conceptrecid"),
+            "metadata": deposition["metadata"],
+        }
+
+    def add(self, deposition):
+        """add (or replace) a deposition as returned from the API, e.g. after
+        it was created"""
+
+        with self._lock:
+            self._add(deposition)
+            self._reindex()
+
+    def save(self):
+        if not self._filename:
+            return
+        with self._lock:
+            tmp = "%s.tmp" % self._filename
+            with open(tmp, "w") as f:
+                json.dump(
+                    {
+                        "server": self._client.server,
+                        "updated": self._updated,
+                        "fetched": self._fetched,
+                        "depositions": list(self._depositions.values()),
+                    },
+                    f,
+                )
+            os.replace(tmp, self._filename)
+
+    def __len__(self):
+        return len(self._depositions)
+
+    def find_title(self, title):
+        """list of published depositions with exactly this title"""
+
+        self.refresh()
+        return list(self._titles.get(title, []))
+
+    def find_id(self, dep_id):
+        self.refresh()
+        return self._depositions.get(dep_id)
+
+    def find_doi(self, doi):
+        self.refresh()
+        return self._dois.get(doi)
@@ -1,56 +1,917 @@
+import io
 import os
+import time
+import zlib
+import queue
+import struct
+import collections
 import zipfile
 import tarfile
 import tempfile
+import threading
 import hashlib
+import functools
+import concurrent.futures
 
+from metrics import Metrics
+from file_scanning import entry_arcname, entry_size
 
-def md5(filename):
-    digest = hashlib.md5()
-    with open(filename, "rb") as f:
-        for c in iter(lambda: f.read(4096), b""):
-            digest.update(c)
+# algorithms offered for checksums - Zenodo itself only reports md5, blake2b
+# and sha1 are typically faster on 64 bit hardware
+CHECKSUM_ALGORITHMS = ("md5", "sha1", "sha256", "blake2b")
+
+
+def checksum(filename, algorithm="md5", block_size=8 << 20):
+    """checksum of filename with named hashlib algorithm, reading in large
+    blocks into a single reused buffer"""
+
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            digest.update(view[:n])
     return digest.hexdigest()
 
 
-def packup_zip(output_filename, files):
-    """make a zip file from list of files"""
+def md5(filename, cache=None, metrics=None):
+    """md5 checksum of filename, from the HashCache cache if given and the
+    file is unchanged since it was last computed - time spent reading the
+    file is recorded as the hash phase in metrics"""
 
-    with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED) as fout:
-        for filename in files:
-            fout.write(filename, arcname=os.path.split(filename)[-1])
+    if metrics is None:
+        metrics = Metrics()
+
+    stat = os.stat(filename)
+    if cache is not None:
+        digest = cache.get(filename, "md5", stat)
+        if digest is not None:
+            return digest
+
+    with metrics.phase("hash", filename) as event:
+        digest = checksum(filename, "md5")
+        event["bytes"] = stat.st_size
+    if cache is not None:
+        cache.put(filename, digest, "md5", stat)
+    return digest
+
+
+def _checksum_or_error(filename, algorithm):
+    """checksum of filename, or the OSError raised trying to read it"""
+
+    try:
+        return checksum(filename, algorithm)
+    except OSError as e:
+        return e
+
+
+def checksums(files, algorithm="md5", jobs=None, cache=None, metrics=None, errors=None):
+    """checksum every file in list with algorithm across a pool of jobs
+    processes (default one per CPU), return a dictionary of filename: digest
+    and report the aggregate throughput - files unchanged since they were
+    last recorded in HashCache cache are not read again. The whole pass is
+    recorded as one hash phase in metrics. If a file cannot be read, raise
+    OSError - unless given a dictionary errors, in which case the error is
+    recorded there and the file left out."""
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if metrics is None:
+        metrics = Metrics()
+
+    def failed(filename, error):
+        if errors is None:
+            raise error
+        errors[filename] = error
+
+    results = {}
+    stats = {}
+    for filename in files:
+        try:
+            stats[filename] = os.stat(filename)
+        except OSError as e:
+            failed(filename, e)
+    if cache is not None:
+        for filename in stats:
+            digest = cache.get(filename, algorithm, stats[filename])
+            if digest is not None:
+                results[filename] = digest
+    todo = [filename for filename in stats if filename not in results]
+
+    total = sum(stats[filename].st_size for filename in todo)
+
+    t0 = time.time()
+    with metrics.phase("hash") as event:
+        if jobs == 1 or len(todo) < 2:
+            digests = [_checksum_or_error(filename, algorithm) for filename in todo]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                digests = list(
+                    pool.map(
+                        _checksum_or_error,
+                        todo,
+                        [algorithm] * len(todo),
+                        chunksize=1,
+                    )
+                )
+        event["bytes"] = total
+    t = time.time() - t0
+
+    for filename, digest in zip(todo, digests):
+        if isinstance(digest, OSError):
+            failed(filename, digest)
+            continue
+        results[filename] = digest
+        if cache is not None:
+            cache.put(filename, digest, algorithm, stats[filename])
+
+    print(
+        "Checksummed %d files (%.1f MB) with %s in %.1fs: %.1f MB/s"
+        % (len(todo), total / 1.0e6, algorithm, t, total / 1.0e6 / max(t, 1e-6))
+    )
+    cached = len(stats) - len(todo)
+    if cached:
+        print("Checksums of %d unchanged files from cache" % cached)
+
+    return results
+
+
+class HashingReader(object):
+    """read-only wrapper for an open file which computes the md5 checksum of
+    the data as it is read, so a file can be checksummed in the same pass as
+    it is uploaded"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._digest = hashlib.md5()
+
+    def __len__(self):
+        return os.fstat(self._fileobj.fileno()).st_size
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._digest.update(data)
+        return data
+
+    def readinto(self, buffer):
+        n = self._fileobj.readinto(buffer)
+        self._digest.update(memoryview(buffer)[:n])
+        return n
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def seek(self, offset):
+        """rewind to offset (where reading started) to read again, e.g. to
+        retry an upload - the checksum starts over"""
+
+        self._digest = hashlib.md5()
+        return self._fileobj.seek(offset)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+class BufferPool(object):
+    """reusable bytearrays of size bytes for reading uploads into - large
+    buffers are expensive to allocate and fault in, so keep up to keep of
+    them for the next upload rather than making new ones each time"""
+
+    def __init__(self, size=4 << 20, keep=16):
+        self.size = size
+        self._keep = keep
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self._keep:
+                self._free.append(buffer)
+
+
+UPLOAD_BUFFERS = BufferPool()
+
+
+class UploadBody(object):
+    """request body to upload an open file (or a HashingReader or
+    ProgressReader around one) from where it is now to the end - read in
+    large blocks into a buffer from pool and handed to the connection as
+    memoryviews, rather than in the 16 KB reads made for a file object.
+    len() gives the Content-Length and each iteration starts again from the
+    beginning, so the upload can be retried."""
 
+    def __init__(self, fileobj, pool=None):
+        self._fileobj = fileobj
+        self._pool = pool or UPLOAD_BUFFERS
+        self._start = fileobj.tell()
 
-def packup_tar_gz(output_filename, files):
-    """make a gzipped tar file from list of files"""
+    def __len__(self):
+        if hasattr(self._fileobj, "__len__"):
+            size = len(self._fileobj)
+        else:
+            size = os.fstat(self._fileobj.fileno()).st_size
+        return size - self._start
+
+    def __iter__(self):
+        self._fileobj.seek(self._start)
+        buffer = self._pool.acquire()
+        view = memoryview(buffer)
+        try:
+            # each block is sent before the next is read over it
+            for n in iter(lambda: self._fileobj.readinto(buffer), 0):
+                yield view[:n]
+        finally:
+            self._pool.release(buffer)
+
+
+def _deflate_block(block, level, zdict):
+    """raw deflate one block, primed with the end of the previous block, and
+    flushed to a byte boundary so that compressed blocks can be concatenated
+    into a single deflate stream"""
+
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+# an empty final block, to terminate a stream of blocks from _deflate_block
+_DEFLATE_END = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+
+class _ParallelDeflate(object):
+    """block-parallel deflate in a pool of jobs threads (zlib releases the GIL
+    while compressing) - blocks are compressed up to 2 x jobs ahead of the
+    consumer, results are handed back in the order submitted"""
+
+    def __init__(self, level, jobs, block_size=1 << 20):
+        self.block_size = block_size
+        self._level = level
+        self._depth = 2 * jobs
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        """stop the threads, dropping any blocks not yet compressed"""
+
+        self._pool.shutdown(cancel_futures=True)
+
+    def submit(self, tag, block, previous, compress=True):
+        """queue block (tagged with tag) for compression, previous is the
+        preceding block of the same stream or None - if not compress the block
+        is passed through in order with compressed None"""
+
+        if block is None or not compress:
+            future = None
+        else:
+            future = self._pool.submit(
+                _deflate_block, block, self._level, previous and previous[-32768:]
+            )
+        self._pending.append((tag, block, future))
+
+    def _result(self):
+        tag, block, future = self._pending.popleft()
+        return tag, block, future and future.result()
+
+    def ready(self):
+        """yield (tag, block, compressed) for blocks which need to be taken to
+        keep the pipeline at depth"""
+
+        while len(self._pending) > self._depth:
+            yield self._result()
+
+    def drain(self):
+        """yield (tag, block, compressed) for all remaining blocks"""
+
+        while self._pending:
+            yield self._result()
+
+    def deflate_files(self, files, stored=()):
+        """yield (filename, block, compressed) for every block of every file,
+        then (filename, None, None) to mark the end of each file - files in
+        stored are read in turn but not compressed"""
 
-    with tarfile.open(output_filename, "w:gz") as fout:
         for filename in files:
-            fout.write(filename, arcname=os.path.split(filename)[-1])
+            previous = None
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(self.block_size), b""):
+                    self.submit(filename, block, previous, filename not in stored)
+                    previous = block
+                    yield from self.ready()
+            self.submit(filename, None, previous)
+        yield from self.drain()
+
+
+class _Precompressed(object):
+    """stands in for the compressor of a zip member being written, handing
+    over the block compressed already by _ParallelDeflate - zipfile still
+    computes the CRC and sizes from the raw data as it is written"""
+
+    def __init__(self):
+        self.compressed = None
+
+    def compress(self, data):
+        compressed, self.compressed = self.compressed, None
+        return compressed
+
+    def flush(self):
+        return _DEFLATE_END
+
+
+def _open_precompressed(fout, zinfo):
+    """open member zinfo of ZipFile fout to write deflated data compressed
+    already - zipfile has no interface for this, so the compressor of the
+    member is replaced, raise RuntimeError if it has none to replace. Return
+    the member and its _Precompressed."""
+
+    dest = fout.open(zinfo, "w")
+    if getattr(dest, "_compressor", None) is None:
+        dest.close()
+        raise RuntimeError("zipfile member has no compressor to replace")
+    dest._compressor = compressor = _Precompressed()
+    return dest, compressor
+
+
+@functools.lru_cache(maxsize=None)
+def parallel_zip_supported():
+    """can zip members be compressed in parallel with this zipfile? Writing
+    them relies on its internals, so check by writing a small archive and
+    reading it back"""
+
+    data = b"parallel zip probe " * 256
+    buffer = io.BytesIO()
+    try:
+        with zipfile.ZipFile(buffer, "w") as fout:
+            zinfo = zipfile.ZipInfo("probe")
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            dest, compressor = _open_precompressed(fout, zinfo)
+            compressor.compressed = _deflate_block(data, 6, None)
+            dest.write(data)
+            dest.close()
+        with zipfile.ZipFile(buffer) as fin:
+            return fin.read("probe") == data
+    except Exception:
+        return False
+
+
+def _packup_zip_parallel(fout, files, level, jobs, stored=()):
+    """write files to open ZipFile fout, deflating across jobs threads - files
+    in stored are stored without compression"""
+
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+
+    dest = None
+    with _ParallelDeflate(level, jobs) as deflate:
+        try:
+            for filename, block, compressed in deflate.deflate_files(files, stored):
+                if dest is None:
+                    zinfo = zipfile.ZipInfo.from_file(
+                        filename, arcname=entry_arcname(filename)
+                    )
+                    if filename in stored:
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                        dest = fout.open(zinfo, "w")
+                    else:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        dest, compressor = _open_precompressed(fout, zinfo)
+                if block is None:
+                    dest.close()
+                    dest = None
+                else:
+                    if compressed is not None:
+                        compressor.compressed = compressed
+                    dest.write(block)
+        finally:
+            if dest is not None:
+                dest.close()
+
+
+class ParallelGzipWriter(object):
+    """write-only file object which gzip compresses everything written to
+    fileobj, compressing blocks across jobs threads - output is one standard
+    gzip member, as if from gzip.GzipFile"""
 
+    def __init__(self, fileobj, level=9, jobs=1):
+        self._fileobj = fileobj
+        self._deflate = _ParallelDeflate(level, jobs)
+        self._buffer = bytearray()
+        self._previous = None
+        self._crc = 0
+        self._size = 0
 
-def packup(archive_name, files):
-    """make a temporary archive in new temporary directory named archive_name, 
-    containing files in list (with directories removed) format as fmt in 
-    (zip, tar.gz)"""
+        self._fileobj.write(
+            b"\x1f\x8b\x08\x00" + struct.pack("<L", int(time.time())) + b"\x00\xff"
+        )
+
+    def _submit(self, block):
+        self._deflate.submit(None, block, self._previous)
+        self._previous = block
+        for _, _, compressed in self._deflate.ready():
+            self._fileobj.write(compressed)
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        block_size = self._deflate.block_size
+        while len(self._buffer) >= block_size:
+            self._submit(bytes(self._buffer[:block_size]))
+            del self._buffer[:block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """finish the gzip stream - does not close fileobj"""
+
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        with self._deflate:
+            for _, _, compressed in self._deflate.drain():
+                self._fileobj.write(compressed)
+        self._fileobj.write(_DEFLATE_END)
+        self._fileobj.write(struct.pack("<LL", self._crc, self._size & 0xFFFFFFFF))
+
+    def abort(self):
+        """stop compressing without finishing the gzip stream, e.g. if writing
+        the data failed"""
+
+        self._deflate.shutdown()
+
+
+# suffixes of files which are already compressed - never worth deflating again
+INCOMPRESSIBLE_SUFFIXES = (
+    ".gz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".lz4",
+    ".zip",
+    ".7z",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".mp4",
+)
+
+
+def compressibility(filename, samples=4, sample_size=1 << 16):
+    """estimate how well filename will compress by deflating (at level 1)
+    samples blocks of sample_size spread through the file - return the ratio
+    compressed / raw and the CPU seconds per byte spent compressing"""
+
+    size = entry_size(filename)
+    if size <= samples * sample_size:
+        offsets = [0]
+        sample_size = size
+    else:
+        step = (size - sample_size) // (samples - 1)
+        offsets = [i * step for i in range(samples)]
+
+    raw = compressed = 0
+    t0 = time.process_time()
+    with open(filename, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            block = f.read(sample_size)
+            raw += len(block)
+            compressed += len(zlib.compress(block, 1))
+    t = time.process_time() - t0
+
+    if not raw:
+        return 1.0, 0.0
+    return compressed / raw, t / raw
+
+
+def plan_compression(files, threshold=0.9):
+    """decide which of files are not worth compressing - those with a known
+    compressed suffix or where a sample does not compress below threshold -
+    return the set of files to store and an estimate of the CPU seconds saved
+    by not deflating them"""
+
+    stored = set()
+    cpu_saved = 0.0
+
+    for filename in files:
+        if filename.lower().endswith(INCOMPRESSIBLE_SUFFIXES):
+            stored.add(filename)
+            continue
+        ratio, cost = compressibility(filename)
+        if ratio > threshold:
+            stored.add(filename)
+            cpu_saved += cost * entry_size(filename)
+
+    return stored, cpu_saved
+
+
+def print_packing_summary(name, summary):
+    """report what packing an archive achieved"""
+
+    print(
+        "Packed %s: %d deflated, %d stored, %.1f MB -> %.1f MB (ratio %.3f)"
+        % (
+            name,
+            summary["deflated"],
+            summary["stored"],
+            summary["raw_bytes"] / 1.0e6,
+            summary["packed_bytes"] / 1.0e6,
+            summary["packed_bytes"] / max(summary["raw_bytes"], 1),
+        )
+    )
+    if summary["stored"]:
+        print(
+            "Not compressed: %.1f MB, saving ~%.1fs CPU"
+            % (summary["stored_bytes"] / 1.0e6, summary["cpu_saved"])
+        )
+
+
+def packup_zip(output_filename, files, level=None, jobs=1, adaptive=True):
+    """make a zip file from list of files - output_filename may also be an
+    open file object. With jobs > 1 members are compressed across jobs
+    threads, where this zipfile allows. If adaptive, files which will not
+    compress are stored rather than deflated. Returns a summary of what was
+    done."""
+
+    if adaptive:
+        stored, cpu_saved = plan_compression(files)
+    else:
+        stored, cpu_saved = set(), 0.0
+
+    with zipfile.ZipFile(
+        output_filename, "w", zipfile.ZIP_DEFLATED, compresslevel=level
+    ) as fout:
+        if jobs > 1 and not parallel_zip_supported():
+            print("Parallel zip compression not supported, compressing serially")
+            jobs = 1
+        if jobs > 1:
+            _packup_zip_parallel(fout, files, level, jobs, stored)
+        else:
+            for filename in files:
+                if filename in stored:
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+                fout.write(
+                    filename,
+                    arcname=entry_arcname(filename),
+                    compress_type=compress_type,
+                )
+        members = fout.infolist()
+
+    return {
+        "deflated": len(members) - len(stored),
+        "stored": len(stored),
+        "raw_bytes": sum(m.file_size for m in members),
+        "packed_bytes": sum(m.compress_size for m in members),
+        "stored_bytes": sum(
+            m.file_size for m in members if m.compress_type == zipfile.ZIP_STORED
+        ),
+        "cpu_saved": cpu_saved,
+    }
+
+
+def packup_tar_gz(output_filename, files, level=None, jobs=1):
+    """make a gzipped tar file from list of files - output_filename may also
+    be an open file object. The gzip compression is spread over jobs threads
+    and the output remains a standard .tar.gz."""
+
+    if level is None:
+        level = 9
+
+    if hasattr(output_filename, "write"):
+        fileobj = output_filename
+    else:
+        fileobj = open(output_filename, "wb")
+
+    try:
+        gz = ParallelGzipWriter(fileobj, level=level, jobs=jobs)
+        try:
+            with tarfile.open(fileobj=gz, mode="w|") as fout:
+                for filename in files:
+                    fout.add(filename, arcname=entry_arcname(filename))
+        except BaseException:
+            gz.abort()
+            raise
+        gz.close()
+    finally:
+        if fileobj is not output_filename:
+            fileobj.close()
+
+
+def archive_format(archive_name):
+    """work out archive format (zip, tar.gz) from the name"""
 
     if archive_name.endswith(".zip"):
-        fmt = "zip"
+        return "zip"
     elif archive_name.endswith(".tar.gz"):
-        fmt = "tar.gz"
+        return "tar.gz"
     else:
-        raise ValueError("unknown format %s" % fmt)
+        raise ValueError("unknown format for %s" % archive_name)
+
+
+def packup(archive_name, files, level=None, jobs=1, adaptive=True, metrics=None):
+    """make a temporary archive in new temporary directory named archive_name,
+    containing files in list (named relative to the directory they were
+    scanned from, else with directories removed) format as fmt in
+    (zip, tar.gz), compressing at level with jobs threads - if adaptive,
+    incompressible files are stored as-is in zip archives. Packing is
+    recorded as the pack phase in metrics, with the bytes read."""
+
+    fmt = archive_format(archive_name)
+    if metrics is None:
+        metrics = Metrics()
 
     tmpdir = tempfile.mkdtemp()
     archive = os.path.join(tmpdir, archive_name)
+    with metrics.phase("pack", archive_name) as event:
+        if fmt == "zip":
+            summary = packup_zip(
+                archive, files, level=level, jobs=jobs, adaptive=adaptive
+            )
+        elif fmt == "tar.gz":
+            packup_tar_gz(archive, files, level=level, jobs=jobs)
+        event["bytes"] = sum(entry_size(filename) for filename in files)
     if fmt == "zip":
-        packup_zip(archive, files)
-    elif fmt == "tar.gz":
-        packup_tar_gz(archive, files)
+        print_packing_summary(archive_name, summary)
 
     return archive
 
 
+def shard_name(archive_name, number):
+    """name of shard number of archive_name e.g. data.tar.gz -> data_003.tar.gz"""
+
+    fmt = archive_format(archive_name)
+    stem = archive_name[: -len(fmt) - 1]
+    return "%s_%03d.%s" % (stem, number, fmt)
+
+
+def shard_files(files, max_size=None, max_files=None):
+    """split list of files in order into lists of at most max_files, and
+    totalling at most max_size bytes - a file bigger than max_size gets a
+    shard to itself"""
+
+    shards = []
+    shard = []
+    size = 0
+    for filename in files:
+        file_size = entry_size(filename)
+        full = (max_files and len(shard) >= max_files) or (
+            max_size and size + file_size > max_size
+        )
+        if shard and full:
+            shards.append(shard)
+            shard = []
+            size = 0
+        shard.append(filename)
+        size += file_size
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+class ScratchSpace(object):
+    """account for the disk used by packed archives waiting to be uploaded,
+    holding back packing while more than limit bytes (None: no limit) are in
+    use - archives are removed, freeing their space, once uploaded"""
+
+    def __init__(self, limit=None):
+        self._limit = limit
+        self._used = 0
+        self._sizes = {}
+        self._cond = threading.Condition()
+
+    def reserve(self, nbytes, cancelled=None):
+        """wait until nbytes more will fit within the limit, or until the
+        threading.Event cancelled is set - an archive bigger than the limit
+        is allowed once nothing else is held, rather than waiting forever"""
+
+        with self._cond:
+            while self._limit and self._used and self._used + nbytes > self._limit:
+                if cancelled is not None and cancelled.is_set():
+                    raise RuntimeError("in packing: cancelled")
+                self._cond.wait(timeout=0.1)
+            self._used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self._used -= nbytes
+            self._cond.notify_all()
+
+    def add(self, archive, estimate):
+        """account for archive at its actual size in place of the estimate
+        reserved before it was packed"""
+
+        size = os.path.getsize(archive)
+        with self._cond:
+            self._sizes[archive] = size
+            self._used += size - estimate
+            self._cond.notify_all()
+
+    def remove(self, upload):
+        """delete an archive added here (and the temporary directory made for
+        it by packup) once uploaded - anything else is left alone"""
+
+        with self._cond:
+            size = self._sizes.pop(upload, None)
+        if size is None:
+            return
+        os.remove(upload)
+        try:
+            os.rmdir(os.path.dirname(upload))
+        except OSError:
+            pass
+        self.release(size)
+
+
+def pack_pipeline(
+    archives, pack=packup, jobs=1, scratch=None, max_size=None, max_files=None
+):
+    """pack each (archive_name, files) in archives with pack(name, files) in
+    the background, up to jobs at once, and yield each archive as soon as it
+    is ready so that uploading overlaps packing - archives which would exceed
+    max_size or max_files are split into numbered shards by shard_files.
+    Space for each archive (estimated from the size of its files) is taken
+    from ScratchSpace scratch before packing, so packing waits for uploaded
+    archives to be removed rather than filling the disk."""
+
+    if scratch is None:
+        scratch = ScratchSpace()
+    cancelled = threading.Event()
+
+    def make(name, files):
+        estimate = sum(entry_size(filename) for filename in files)
+        scratch.reserve(estimate, cancelled)
+        try:
+            archive = pack(name, files)
+        except BaseException:
+            scratch.release(estimate)
+            raise
+        if isinstance(archive, ArchiveStream):
+            # built as it is uploaded, takes no disk
+            scratch.release(estimate)
+        else:
+            scratch.add(archive, estimate)
+        return archive
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for archive_name, files in archives:
+            shards = shard_files(files, max_size, max_files)
+            if len(shards) <= 1:
+                futures.append(pool.submit(make, archive_name, files))
+                continue
+            print("Splitting %s into %d shards" % (archive_name, len(shards)))
+            for j, shard in enumerate(shards):
+                futures.append(
+                    pool.submit(make, shard_name(archive_name, j + 1), shard)
+                )
+
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # if the upload failed, do not go on packing the rest
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+
+
+class _QueueWriter(object):
+    """write-only file object which hands data on in chunks through a bounded
+    queue, blocking the writer while the queue is full"""
+
+    def __init__(self, chunks, chunk_size, abandoned):
+        self._chunks = chunks
+        self._chunk_size = chunk_size
+        self._abandoned = abandoned
+        self._buffer = bytearray()
+
+    def _put(self, chunk):
+        while True:
+            if self._abandoned.is_set():
+                raise IOError("archive stream abandoned by reader")
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer[: self._chunk_size]))
+            del self._buffer[: self._chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+class ArchiveStream(object):
+    """archive named archive_name of files, built on the fly as it is iterated
+    so it can be passed straight to an upload as the request body without a
+    temporary file - at most max_chunks chunks of chunk_size bytes are held in
+    memory at any time. The md5 checksum of the archive is computed as it is
+    read."""
+
+    def __init__(
+        self,
+        archive_name,
+        files,
+        chunk_size=1 << 20,
+        max_chunks=8,
+        level=None,
+        jobs=1,
+        adaptive=True,
+    ):
+        self.name = archive_name
+        self._fmt = archive_format(archive_name)
+        self._files = files
+        self._level = level
+        self._jobs = jobs
+        self._adaptive = adaptive
+        self._chunk_size = chunk_size
+        self._max_chunks = max_chunks
+        self._digest = hashlib.md5()
+
+    def _pack(self, writer, errors):
+        try:
+            # zipfile falls back to data descriptors on unseekable output
+            if self._fmt == "zip":
+                summary = packup_zip(
+                    writer,
+                    self._files,
+                    level=self._level,
+                    jobs=self._jobs,
+                    adaptive=self._adaptive,
+                )
+                print_packing_summary(self.name, summary)
+            elif self._fmt == "tar.gz":
+                packup_tar_gz(writer, self._files, level=self._level, jobs=self._jobs)
+            writer.close()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                writer._put(None)
+            except IOError:
+                pass
+
+    def __iter__(self):
+        # each iteration builds the archive afresh, so it can be sent again
+        self._digest = hashlib.md5()
+        chunks = queue.Queue(maxsize=self._max_chunks)
+        abandoned = threading.Event()
+        errors = []
+        writer = _QueueWriter(chunks, self._chunk_size, abandoned)
+        packer = threading.Thread(target=self._pack, args=(writer, errors))
+        packer.daemon = True
+        packer.start()
+
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                self._digest.update(chunk)
+                yield chunk
+        finally:
+            # if the reader gave up (e.g. failed upload) release the packer
+            abandoned.set()
+            packer.join()
+
+        if errors:
+            raise errors[0]
+
+    def hexdigest(self):
+        """md5 checksum of the archive, once it has been read completely"""
+        return self._digest.hexdigest()
+
+
 if __name__ == "__main__":
     srcdir = os.path.dirname(os.path.abspath(__file__))
     files = [os.path.join(srcdir, f) for f in os.listdir(srcdir) if f.endswith(".py")]
@@ -0,0 +1,111 @@
+import concurrent.futures
+import fnmatch
+import os
+
+
+class FileEntry(str):
+    """path of a file found by scan_files, which also carries what was learned
+    about the file while scanning - arcname (the path relative to the
+    directory scanned, as used in archives), size and mtime_ns - so that
+    packing and planning need not stat it again. Anywhere else it is just the
+    path."""
+
+    def __new__(cls, path, arcname=None, size=None, mtime_ns=None):
+        self = str.__new__(cls, path)
+        self.arcname = arcname or os.path.split(path)[-1]
+        self.size = size
+        self.mtime_ns = mtime_ns
+        return self
+
+    def __getnewargs__(self):
+        # so entries survive pickling e.g. to a process pool for checksums
+        return (str(self), self.arcname, self.size, self.mtime_ns)
+
+
+def entry_arcname(filename):
+    """name for filename inside an archive - relative to the directory it was
+    scanned from, else the file name alone"""
+
+    return getattr(filename, "arcname", None) or os.path.split(filename)[-1]
+
+
+def entry_size(filename):
+    """size of filename, from the scan if known"""
+
+    size = getattr(filename, "size", None)
+    if size is None:
+        size = os.path.getsize(filename)
+    return size
+
+
+def _matches(name, arcname, patterns):
+    """does the file name or the relative path match any glob in patterns?"""
+
+    return any(
+        fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(arcname, pattern)
+        for pattern in patterns
+    )
+
+
+def _scan_directory(path, arcdir, recursive, include, exclude):
+    """list one directory in a single pass - return the FileEntry for every
+    file wanted, sorted by name, and the (path, arcname) of every directory to
+    descend into"""
+
+    files = []
+    directories = []
+
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if arcdir:
+                arcname = "%s/%s" % (arcdir, entry.name)
+            else:
+                arcname = entry.name
+            if exclude and _matches(entry.name, arcname, exclude):
+                continue
+            if entry.is_dir():
+                if recursive:
+                    directories.append((entry.path, arcname))
+                continue
+            if not entry.is_file():
+                continue
+            if include and not _matches(entry.name, arcname, include):
+                continue
+            # the one stat per file, for size and mtime
+            stat = entry.stat()
+            files.append(FileEntry(entry.path, arcname, stat.st_size, stat.st_mtime_ns))
+
+    return files, directories
+
+
+def scan_files(directory, recursive=False, include=(), exclude=(), jobs=1):
+    """yield a FileEntry for each file in directory (and with recursive, in
+    the directories below it), lazily as each directory is read - with
+    include, only files whose name or relative path matches one of the glob
+    patterns, never those matching exclude (which also prunes directories).
+    With jobs > 1, directories are read across a pool of threads, which
+    helps most on network filesystems where every stat is a round trip; the
+    files of each directory are still yielded together in name order."""
+
+    def scan(path, arcdir):
+        return _scan_directory(path, arcdir, recursive, include, exclude)
+
+    if jobs == 1:
+        todo = [(directory, "")]
+        while todo:
+            files, directories = scan(*todo.pop())
+            yield from files
+            todo.extend(reversed(directories))
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(scan, directory, "")}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                files, directories = future.result()
+                for path, arcdir in directories:
+                    pending.add(pool.submit(scan, path, arcdir))
+                yield from files
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class HashCache(object):
+    """persistent cache of file checksums in SQLite, keyed on path and
+    algorithm and valid only while the size, mtime and inode of the file are
+    unchanged - at most max_entries are kept, least recently used are evicted
+    first (checked every check_every insertions)"""
+
+    def __init__(self, filename, max_entries=1000000, check_every=1000):
+        self._max_entries = max_entries
+        self._check_every = check_every
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS checksums ("
+                "path TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, "
+                "inode INTEGER, digest TEXT, used REAL, "
+                "PRIMARY KEY (path, algorithm))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS checksums_used ON checksums (used)"
+            )
+            self._evict()
+
+    def _evict(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM checksums").fetchone()
+        if count > self._max_entries:
+            self._db.execute(
+                "DELETE FROM checksums WHERE rowid IN "
+                "(SELECT rowid FROM checksums ORDER BY used LIMIT ?)",
+                (count - self._max_entries,),
+            )
+
+    def get(self, path, algorithm="md5", stat=None):
+        """cached checksum of path, or None if not known or the file changed -
+        stale entries are removed"""
+
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, inode, digest FROM checksums "
+                "WHERE path = ? AND algorithm = ?",
+                (path, algorithm),
+            ).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                self._db.execute(
+                    "DELETE FROM checksums WHERE path = ? AND algorithm = ?",
+                    (path, algorithm),
+                )
+                return None
+            self._db.execute(
+                "UPDATE checksums SET used = ? WHERE path = ? AND algorithm = ?",
+                (time.time(), path, algorithm),
+            )
+            return row[3]
+
+    def put(self, path, digest, algorithm="md5", stat=None):
+        """record checksum of path - stat should be taken before the file was
+        read so a change while hashing is not cached"""
+
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    algorithm,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_ino,
+                    digest,
+                    time.time(),
+                ),
+            )
+            self._puts += 1
+            if self._puts % self._check_every == 0:
+                self._evict()
+
+    def invalidate(self, path=None):
+        """forget path, or everything"""
+
+        with self._lock, self._db:
+            if path is None:
+                self._db.execute("DELETE FROM checksums")
+            else:
+                self._db.execute(
+                    "DELETE FROM checksums WHERE path = ?", (os.path.abspath(path),)
+                )
+
+    def close(self):
+        with self._lock, self._db:
+            self._evict()
+        self._db.close()
@@ -1,23 +1,95 @@
+import argparse
+import concurrent.futures
 import csv
-import sys
+import hashlib
 import os
 import json
+import sqlite3
 
 
-def make_upload_metadata(csv_input, data_locations):
-    """example of how to make the upload metadata files"""
+class MetadataState(object):
+    """what earlier runs learned, kept in SQLite - the data location index
+    (rebuilt only when the data locations file changes) and a hash of each
+    row a metadata file was made from, so unchanged rows can be skipped"""
 
-    # read a metadata file containing data we need
-    text = open(csv_input, "rb").read().decode("ascii", errors="ignore").split("\n")
-    r = csv.reader(text)
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS locations (key TEXT PRIMARY KEY, path TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS source "
+                "(filename TEXT, size INTEGER, mtime_ns INTEGER)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rows (set_id TEXT PRIMARY KEY, digest TEXT)"
+            )
 
-    # build a data location database - this is a hash table between a data set
-    # key from the CSV above and the directory on disk
+    def index_locations(self, data_locations):
+        """build the data location database - a hash table between a data set
+        key from the CSV and the directory on disk - unless already built
+        from this data locations file as it is now"""
 
-    loc_db = {}
-    for record in open(data_location):
-        key = os.path.split(record)[-1].lower().strip()
-        loc_db[key] = record.strip()
+        stat = os.stat(data_locations)
+        source = (os.path.abspath(data_locations), stat.st_size, stat.st_mtime_ns)
+        if self._db.execute("SELECT * FROM source").fetchone() == source:
+            return False
+
+        def records():
+            with open(data_locations) as f:
+                for record in f:
+                    key = os.path.split(record)[-1].lower().strip()
+                    yield key, record.strip()
+
+        with self._db:
+            self._db.execute("DELETE FROM locations")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO locations VALUES (?, ?)", records()
+            )
+            self._db.execute("DELETE FROM source")
+            self._db.execute("INSERT INTO source VALUES (?, ?, ?)", source)
+        return True
+
+    def location(self, key):
+        row = self._db.execute(
+            "SELECT path FROM locations WHERE key = ?", (key,)
+        ).fetchone()
+        return row and row[0]
+
+    def digest(self, set_id):
+        row = self._db.execute(
+            "SELECT digest FROM rows WHERE set_id = ?", (set_id,)
+        ).fetchone()
+        return row and row[0]
+
+    def made(self, digests):
+        """record the (set_id, digest) of rows whose metadata was made"""
+
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?)", digests)
+
+    def close(self):
+        self._db.close()
+
+
+def row_digest(row, directory):
+    """hash of everything a metadata file is made from"""
+
+    return hashlib.sha1(json.dumps([row, directory]).encode()).hexdigest()
+
+
+def write_json(filename, metadata):
+    """write metadata to filename, replacing it atomically"""
+
+    tmp = "%s.tmp" % filename
+    with open(tmp, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp, filename)
+
+
+def row_metadata(row, directory):
+    """make the metadata dictionary for one spreadsheet row"""
 
     # author information etc.
 
@@ -26,75 +98,186 @@ def make_upload_metadata(csv_input, data_locations):
 
     authors = {"Doe, John R.": DLS, "Other, Andrea N.": "Other laboratory"}
 
-    # iterate through the spreadsheet, making a metadata json file for each
-    # row in the file
+    set_id = row[0].lower()
+    smiles = row[2]
+    compound = row[4]
+    pdb_id = row[6]
 
-    for row in r:
-        if not len(row):
-            continue
+    # make metadata.json files - this is the merge step
 
-        # how we interpret the csv will be case by case
-        if row[5] != "Deposited":
-            continue
+    title = (
+        "Raw diffraction data for structure of SARS-CoV-2 main protease with %s (ID: %s / PDB: %s)"
+        % (compound, set_id, pdb_id)
+    )
 
-        set_id = row[0].lower()
-        smiles = row[2]
-        compound = row[4]
-        pdb_id = row[6]
+    description = """Raw diffraction data for %s / PDB ID %s (see: https://www.ebi.ac.uk/pdbe/entry/pdb/%s) - SARS-CoV-2 main protease in complex with %s (SMILES:%s) collected as part of an XChem crystallographic fragment screening campaign. The deposited structure was automatically processed with standard Diamond tools and PanDDA, however the raw data are being made available to allow reanalysis by any interested party. 
 
-        # make metadata.json files - this is the merge step
+For more details see: https://www.diamond.ac.uk/covid-19/for-scientists/Main-protease-structure-and-XChem.html
+""" % (
+        set_id,
+        pdb_id,
+        pdb_id,
+        compound,
+        smiles,
+    )
 
-        title = (
-            "Raw diffraction data for structure of SARS-CoV-2 main protease with %s (ID: %s / PDB: %s)"
-            % (compound, set_id, pdb_id)
-        )
+    # if you want to make .zip files from CBF files use this - if you
+    # want to include > 1 directory you can have > 1 zip file but these
+    # have to match 1:1
+    archive = ["%s.zip" % set_id]
 
-        description = """Raw diffraction data for %s / PDB ID %s (see: https://www.ebi.ac.uk/pdbe/entry/pdb/%s) - SARS-CoV-2 main protease in complex with %s (SMILES:%s) collected as part of an XChem crystallographic fragment screening campaign. The deposited structure was automatically processed with standard Diamond tools and PanDDA, however the raw data are being made available to allow reanalysis by any interested party. 
+    # alt: if you have HDF5 can just give the directory and it will upload
+    # or an explicit file list
 
-For more details see: https://www.diamond.ac.uk/covid-19/for-scientists/Main-protease-structure-and-XChem.html
-""" % (
-            set_id,
-            pdb_id,
-            pdb_id,
-            compound,
-            smiles,
-        )
-
-        # if you want to make .zip files from CBF files use this - if you
-        # want to include > 1 directory you can have > 1 zip file but these
-        # have to match 1:1
-        archive = ["%s.zip" % set_id]
-        directory = [loc_db[set_id]]
-
-        # alt: if you have HDF5 can just give the directory and it will upload
-        # or an explicit file list
-
-        # make the metadata dictionary - N.B. by default authors in alphabetical
-        # order (case *insensitive*)
-        metadata = {
-            "directory": directory,
-            "archive": archive,
-            "title": title,
-            "description": description,
-            "creators": [
-                {"name": name, "affiliation": authors[name]}
-                for name in sorted(authors, key=str.casefold)
-            ],
-            "communities": [{"identifier": "mx", "identifier": "covid-19"}],
-            "keywords": [
-                "COVID-19",
-                "SARS-CoV-2 main protease",
-                "automated upload",
-                "PDB:%s" % pdb_id,
-            ],
-        }
-        with open("%s.json" % set_id, "w") as f:
-            json.dump(metadata, f)
+    # make the metadata dictionary - N.B. by default authors in alphabetical
+    # order (case *insensitive*)
+    return {
+        "directory": [directory],
+        "archive": archive,
+        "title": title,
+        "description": description,
+        "creators": [
+            {"name": name, "affiliation": authors[name]}
+            for name in sorted(authors, key=str.casefold)
+        ],
+        "communities": [{"identifier": "mx", "identifier": "covid-19"}],
+        "keywords": [
+            "COVID-19",
+            "SARS-CoV-2 main protease",
+            "automated upload",
+            "PDB:%s" % pdb_id,
+        ],
+    }
+
+
+def make_upload_metadata(
+    csv_input,
+    data_locations,
+    output=".",
+    state="upload_metadata.db",
+    manifest=None,
+    jobs=4,
+    force=False,
+    changed_manifest=None,
+):
+    """example of how to make the upload metadata files - only rows which are
+    new or changed since the last run (according to state) are written, across
+    jobs threads. New rows are listed in manifest, to deposit with
+    zenodo_batch.py --manifest, changed rows (already deposited) in
+    changed_manifest, to update with zenodo_updater.py -b - return the list
+    of files written"""
+
+    state = MetadataState(state)
+    if state.index_locations(data_locations):
+        print("Indexed data locations from %s" % data_locations)
+
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+    written = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+
+        # read a metadata file containing data we need - a row at a time,
+        # iterate through the spreadsheet, making a metadata json file for
+        # each new or changed row in the file
+        with open(csv_input, encoding="ascii", errors="ignore", newline="") as f:
+            for row in csv.reader(f):
+                if not len(row):
+                    continue
+
+                # how we interpret the csv will be case by case
+                if row[5] != "Deposited":
+                    continue
+
+                set_id = row[0].lower()
+                directory = state.location(set_id)
+                if directory is None:
+                    print("No data location for %s" % set_id)
+                    continue
 
+                filename = os.path.join(output, "%s.json" % set_id)
+                digest = row_digest(row, directory)
+                previous = state.digest(set_id)
+                if previous == digest and os.path.exists(filename) and not force:
+                    counts["unchanged"] += 1
+                    continue
+                kind = "new" if previous is None else "changed"
+                counts[kind] += 1
+
+                futures.append(
+                    pool.submit(write_json, filename, row_metadata(row, directory))
+                )
+                written.append((set_id, digest, filename, kind))
+
+        for future in futures:
+            future.result()
+
+    # only record rows as made once their files are written
+    state.made((set_id, digest) for set_id, digest, filename, kind in written)
+    state.close()
+    for set_id, digest, filename, kind in written:
         print(set_id)
 
+    for kind, listing in (("new", manifest), ("changed", changed_manifest)):
+        if listing:
+            with open(listing, "w") as f:
+                for set_id, digest, filename, made in written:
+                    if made == kind:
+                        f.write("%s\n" % filename)
+
+    print(
+        "Metadata: %d new, %d changed, %d unchanged"
+        % (counts["new"], counts["changed"], counts["unchanged"])
+    )
+    return [filename for set_id, digest, filename, kind in written]
+
+
+def main():
+    """main() - parse args, make metadata for new or changed rows"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_input", help="spreadsheet of data sets")
+    parser.add_argument(
+        "data_locations", help="file listing the directory of each data set"
+    )
+    parser.add_argument(
+        "-o", "--output", help="directory to write metadata to", default="."
+    )
+    parser.add_argument(
+        "--state",
+        help="SQLite file recording the location index and rows already made "
+        "(default upload_metadata.db)",
+        default="upload_metadata.db",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="write the list of metadata files made for new rows to file, "
+        "for zenodo_batch.py --manifest",
+    )
+    parser.add_argument(
+        "--changed-manifest",
+        help="write the list of metadata files remade for changed rows to "
+        "file, for zenodo_updater.py -b",
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="number of files to write at once", type=int, default=4
+    )
+    parser.add_argument(
+        "--force", help="remake every metadata file", action="store_true"
+    )
+    args = parser.parse_args()
+
+    make_upload_metadata(
+        args.csv_input,
+        args.data_locations,
+        output=args.output,
+        state=args.state,
+        manifest=args.manifest,
+        jobs=args.jobs,
+        force=args.force,
+        changed_manifest=args.changed_manifest,
+    )
+
 
 if __name__ == "__main__":
-    csv_input = sys.argv[1]
-    data_locations = sys.argv[2]
-    make_upload_metadata(csv_input, data_locations)
+    main()
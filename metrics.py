@@ -0,0 +1,248 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+METRICS_FORMATS = ("json", "prometheus")
+
+
+class ProgressReader(object):
+    """read-only wrapper for an open file which reports the number of bytes
+    read to callback as they are read, e.g. for Metrics.transferred"""
+
+    def __init__(self, fileobj, callback):
+        self._fileobj = fileobj
+        self._callback = callback
+
+    def __len__(self):
+        if hasattr(self._fileobj, "__len__"):
+            return len(self._fileobj)
+        return os.fstat(self._fileobj.fileno()).st_size
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._callback(len(data))
+        return data
+
+    def readinto(self, buffer):
+        n = self._fileobj.readinto(buffer)
+        self._callback(n)
+        return n
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def seek(self, offset):
+        """rewind to offset e.g. to retry an upload - bytes read past there
+        are taken off the count again"""
+
+        self._callback(offset - self._fileobj.tell())
+        return self._fileobj.seek(offset)
+
+
+class ProgressIterable(object):
+    """wrapper for a re-iterable body such as an ArchiveStream which reports
+    the size of each chunk to callback as it is sent"""
+
+    def __init__(self, iterable, callback):
+        self._iterable = iterable
+        self._callback = callback
+        self._sent = 0
+
+    def __iter__(self):
+        # sending again e.g. to retry - take the last attempt off the count
+        self._callback(-self._sent)
+        self._sent = 0
+        for chunk in self._iterable:
+            self._sent += len(chunk)
+            self._callback(len(chunk))
+            yield chunk
+
+
+class Metrics(object):
+    """record the wall time, bytes and number of calls of each phase of an
+    upload (pack, hash, find, create, update, upload, publish, ...) - with
+    filename, each phase is written as a JSON line as it completes or, in
+    prometheus format, the totals are written as a textfile on close. With
+    progress, the bytes sent and current rate are shown on stderr."""
+
+    def __init__(self, filename=None, fmt="json", progress=False, interval=1.0):
+        if fmt not in METRICS_FORMATS:
+            raise ValueError("unknown metrics format %s" % fmt)
+
+        self._filename = filename
+        self._fmt = fmt
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._transferred = 0
+        self._started = time.time()
+        self._log = None
+        if filename and fmt == "json":
+            self._log = open(filename, "a")
+
+        self._stop = threading.Event()
+        self._progress = None
+        if progress:
+            self._progress = threading.Thread(
+                target=self._show_progress, args=(interval,)
+            )
+            self._progress.daemon = True
+            self._progress.start()
+
+    @contextlib.contextmanager
+    def phase(self, name, item=None):
+        """time a phase of work on item (e.g. a file name) - the body may set
+        event["bytes"] to the number of bytes handled. Failures are counted
+        separately from completed calls."""
+
+        event = {"phase": name, "bytes": 0}
+        if item is not None:
+            event["item"] = item
+        t0 = time.time()
+        try:
+            yield event
+        except BaseException:
+            event["failed"] = True
+            raise
+        finally:
+            event["seconds"] = time.time() - t0
+            event["time"] = t0
+            self._record(event)
+
+    def _record(self, event):
+        with self._lock:
+            total = self._totals.setdefault(
+                event["phase"], {"calls": 0, "failed": 0, "seconds": 0.0, "bytes": 0}
+            )
+            if event.get("failed"):
+                total["failed"] += 1
+            else:
+                total["calls"] += 1
+            total["seconds"] += event["seconds"]
+            total["bytes"] += event["bytes"]
+
+            if self._log is not None:
+                if event["bytes"] and event["seconds"] > 0:
+                    event["bytes_per_second"] = event["bytes"] / event["seconds"]
+                self._log.write("%s\n" % json.dumps(event))
+                self._log.flush()
+
+    def transferred(self, nbytes):
+        """count nbytes more sent over the network (negative if resending)"""
+
+        with self._lock:
+            self._transferred += nbytes
+
+    def totals(self):
+        """dictionary of phase name: calls, failed, seconds, bytes"""
+
+        with self._lock:
+            return {name: dict(total) for name, total in self._totals.items()}
+
+    def _show_progress(self, interval):
+        last = 0
+        while not self._stop.wait(interval):
+            with self._lock:
+                sent = self._transferred
+                done = self._totals.get("upload", {}).get("calls", 0)
+            sys.stderr.write(
+                "\rSent %.1f MB, %d files done, %.1f MB/s    "
+                % (sent / 1.0e6, done, (sent - last) / 1.0e6 / interval)
+            )
+            sys.stderr.flush()
+            last = sent
+
+    def report(self):
+        print(
+            "%-12s %8s %8s %10s %10s %10s"
+            % ("phase", "calls", "failed", "seconds", "MB", "MB/s")
+        )
+        for name, total in sorted(self.totals().items()):
+            print(
+                "%-12s %8d %8d %10.2f %10.1f %10.1f"
+                % (
+                    name,
+                    total["calls"],
+                    total["failed"],
+                    total["seconds"],
+                    total["bytes"] / 1.0e6,
+                    total["bytes"] / 1.0e6 / max(total["seconds"], 1e-6),
+                )
+            )
+
+    def _prometheus(self, counters):
+        lines = []
+
+        def metric(name, kind, text, values):
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, labels, value))
+
+        totals = sorted(self.totals().items())
+        for key, text in (
+            ("seconds", "wall time spent in each phase"),
+            ("bytes", "bytes handled in each phase"),
+            ("calls", "completed calls of each phase"),
+            ("failed", "failed calls of each phase"),
+        ):
+            metric(
+                "zenodo_phase_%s_total" % key,
+                "counter",
+                text,
+                [('{phase="%s"}' % name, total[key]) for name, total in totals],
+            )
+        for key, value in sorted((counters or {}).items()):
+            metric(
+                "zenodo_http_%s_total" % key,
+                "counter",
+                "HTTP requests %s" % key,
+                [("", value)],
+            )
+        metric(
+            "zenodo_run_started_seconds",
+            "gauge",
+            "time the run started",
+            [("", self._started)],
+        )
+        metric(
+            "zenodo_run_duration_seconds",
+            "gauge",
+            "wall time of the run",
+            [("", time.time() - self._started)],
+        )
+        return "\n".join(lines) + "\n"
+
+    def close(self, counters=None):
+        """stop the progress display and write out the totals, with the
+        request counters from ZenodoClient.counters() (retries &c.) - the
+        prometheus textfile is replaced atomically so a collector never
+        reads it half written"""
+
+        if self._progress is not None:
+            self._stop.set()
+            self._progress.join()
+            sys.stderr.write("\n")
+
+        if self._log is not None:
+            self._log.write(
+                "%s\n"
+                % json.dumps(
+                    {
+                        "time": time.time(),
+                        "phase": "total",
+                        "seconds": time.time() - self._started,
+                        "phases": self.totals(),
+                        "http": counters or {},
+                    }
+                )
+            )
+            self._log.close()
+            self._log = None
+        elif self._filename and self._fmt == "prometheus":
+            tmp = "%s.tmp" % self._filename
+            with open(tmp, "w") as f:
+                f.write(self._prometheus(counters))
+            os.replace(tmp, self._filename)
@@ -0,0 +1,448 @@
+#!/usr/bin/env dials.python
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+class ZenodoState(object):
+    """in-memory depositions, records and bucket contents behind the mock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.depositions = {}
+        self.buckets = {}
+        self.next_id = 1
+
+    def new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+        return new_id
+
+
+class MockZenodoHandler(http.server.BaseHTTPRequestHandler):
+    """the subset of the Zenodo deposit API used by this package - records
+    search, depositions list / create / get / put / edit / publish / new
+    version, file listing / delete and bucket PUT / GET - with latency,
+    bandwidth and error injection set on the server"""
+
+    protocol_version = "HTTP/1.1"
+
+    # buffer each response so headers and body go out in one segment, rather
+    # than waiting on delayed ACK between the two
+    wbufsize = 1 << 16
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None):
+        if status == 204:
+            # no content, not even an empty body
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = json.dumps(body if body is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        """read the request body in chunks, at most server.bandwidth bytes a
+        second, passing each chunk to a digest - return (digest, size)"""
+
+        digest = hashlib.md5()
+        size = 0
+        bandwidth = self.server.bandwidth
+        t0 = time.time()
+
+        def chunks():
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                while True:
+                    length = int(self.rfile.readline().strip(), 16)
+                    if not length:
+                        self.rfile.readline()
+                        return
+                    yield self.rfile.read(length)
+                    self.rfile.readline()
+            else:
+                remaining = int(self.headers.get("Content-Length", 0))
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    remaining -= len(chunk)
+                    yield chunk
+
+        for chunk in chunks():
+            digest.update(chunk)
+            size += len(chunk)
+            if bandwidth:
+                ahead = size / bandwidth - (time.time() - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        return digest, size
+
+    def _json_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _route(self, method):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        # consume any body before deciding to fail, so the connection stays
+        # usable for the client
+        if method == "PUT" and url.path.startswith("/files/"):
+            body = self._read_body()
+        elif method in ("PUT", "POST"):
+            body = self._json_body()
+        else:
+            body = None
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            return self._send(random.choice((429, 503)), {"message": "injected"})
+
+        for pattern, handler in self.routes[method]:
+            match = re.match(pattern, url.path)
+            if match:
+                return handler(self, query, body, *match.groups())
+        return self._send(404, {"message": "not found"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    # API implementation
+
+    def _base(self):
+        return "http://%s:%d" % self.server.server_address[:2]
+
+    def _deposition(self, dep_id):
+        return self.server.state.depositions.get(int(dep_id))
+
+    def _files(self, deposition):
+        contents = self.server.state.buckets[deposition["bucket"]]
+        return [
+            {
+                "id": key,
+                "filename": key,
+                "filesize": f["size"],
+                "checksum": f["checksum"],
+            }
+            for key, f in sorted(contents.items())
+        ]
+
+    def _view(self, deposition):
+        base = self._base()
+        view = dict(deposition)
+        view["files"] = self._files(deposition)
+        view["links"] = {
+            "self": "%s/api/deposit/depositions/%d" % (base, deposition["id"]),
+            "bucket": "%s/files/%s" % (base, deposition["bucket"]),
+        }
+        if deposition.get("latest_draft"):
+            view["links"]["latest_draft"] = "%s/api/deposit/depositions/%d" % (
+                base,
+                deposition["latest_draft"],
+            )
+        return view
+
+    def records(self, query, body):
+        match = re.match(r'title:"(.*)"$', query.get("q", [""])[0])
+        title = match and match.group(1)
+        with self.server.state.lock:
+            hits = [
+                self._view(d)
+                for d in self.server.state.depositions.values()
+                if d["submitted"]
+                and d.get("latest", True)
+                and (title is None or d["title"] == title)
+            ]
+        size = int(query.get("size", [10])[0])
+        self._send(200, {"hits": {"total": len(hits), "hits": hits[:size]}})
+
+    def list_depositions(self, query, body):
+        page = int(query.get("page", [1])[0])
+        size = int(query.get("size", [10])[0])
+        with self.server.state.lock:
+            depositions = sorted(
+                self.server.state.depositions.values(),
+                key=lambda d: d["modified"],
+                reverse=True,
+            )[(page - 1) * size : page * size]
+            self._send(200, [self._view(d) for d in depositions])
+
+    def create(self, query, body):
+        state = self.server.state
+        dep_id = state.new_id()
+        now = datetime.datetime.utcnow().isoformat()
+        deposition = {
+            "id": dep_id,
+            "title": "",
+            "metadata": {},
+            "created": now,
+            "modified": now,
+            "submitted": False,
+            "state": "unsubmitted",
+            "doi": "",
+            "bucket": "bucket-%d" % dep_id,
+            "conceptrecid": str(dep_id),
+        }
+        with state.lock:
+            state.depositions[dep_id] = deposition
+            state.buckets[deposition["bucket"]] = {}
+            self._send(201, self._view(deposition))
+
+    def get_deposition(self, query, body, dep_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            self._send(200, self._view(deposition))
+
+    def put_deposition(self, query, body, dep_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            if deposition["state"] == "done":
+                return self._send(400, {"message": "deposition not in edit mode"})
+            deposition["metadata"] = body.get("metadata", {})
+            deposition["title"] = deposition["metadata"].get("title", "")
+            deposition["modified"] = datetime.datetime.utcnow().isoformat()
+            self._send(200, self._view(deposition))
+
+    def edit(self, query, body, dep_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            deposition["state"] = "inprogress"
+            self._send(201, self._view(deposition))
+
+    def publish(self, query, body, dep_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            # as Zenodo, a new version must have different files from every
+            # earlier version
+            files = self._files(deposition)
+            earlier = self._deposition(deposition.get("previous", 0))
+            while earlier is not None and not deposition["submitted"]:
+                if self._files(earlier) == files:
+                    return self._send(
+                        400, {"message": "files are the same as a previous version"}
+                    )
+                earlier = self._deposition(earlier.get("previous", 0))
+            deposition["submitted"] = True
+            deposition["state"] = "done"
+            # only the latest version of a record is found by searches
+            previous = self._deposition(deposition.get("previous", 0))
+            if previous is not None:
+                previous["latest"] = False
+                previous["latest_draft"] = None
+            deposition["doi"] = "10.5072/zenodo.%d" % deposition["id"]
+            deposition["modified"] = datetime.datetime.utcnow().isoformat()
+            self._send(202, self._view(deposition))
+
+    def new_version(self, query, body, dep_id):
+        state = self.server.state
+        new_id = state.new_id()
+        with state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            if not deposition["submitted"]:
+                return self._send(400, {"message": "deposition not published"})
+            if deposition.get("latest_draft"):
+                # a new version already in progress
+                return self._send(201, self._view(deposition))
+            now = datetime.datetime.utcnow().isoformat()
+            draft = dict(
+                deposition,
+                id=new_id,
+                metadata=dict(deposition["metadata"]),
+                created=now,
+                modified=now,
+                submitted=False,
+                state="unsubmitted",
+                doi="",
+                bucket="bucket-%d" % new_id,
+                previous=deposition["id"],
+            )
+            # the new version starts with the files of the last
+            state.depositions[new_id] = draft
+            state.buckets[draft["bucket"]] = dict(state.buckets[deposition["bucket"]])
+            deposition["latest_draft"] = new_id
+            self._send(201, self._view(deposition))
+
+    def delete_file(self, query, body, dep_id, file_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            if deposition["submitted"]:
+                return self._send(400, {"message": "deposition is published"})
+            contents = self.server.state.buckets[deposition["bucket"]]
+            if contents.pop(file_id, None) is None:
+                return self._send(404, {"message": "no such file"})
+            self._send(204)
+
+    def list_files(self, query, body, dep_id):
+        with self.server.state.lock:
+            deposition = self._deposition(dep_id)
+            if deposition is None:
+                return self._send(404, {"message": "no such deposition"})
+            self._send(200, self._files(deposition))
+
+    def bucket_put(self, query, body, bucket, key):
+        digest, size = body
+        checksum = "md5:%s" % digest.hexdigest()
+        with self.server.state.lock:
+            if bucket not in self.server.state.buckets:
+                return self._send(404, {"message": "no such bucket"})
+            self.server.state.buckets[bucket][key] = {
+                "size": size,
+                "checksum": digest.hexdigest(),
+            }
+        self._send(201, {"key": key, "size": size, "checksum": checksum})
+
+    def bucket_get(self, query, body, bucket):
+        with self.server.state.lock:
+            contents = self.server.state.buckets.get(bucket)
+            if contents is None:
+                return self._send(404, {"message": "no such bucket"})
+            self._send(
+                200,
+                {
+                    "contents": [
+                        {
+                            "key": key,
+                            "size": f["size"],
+                            "checksum": "md5:%s" % f["checksum"],
+                        }
+                        for key, f in sorted(contents.items())
+                    ]
+                },
+            )
+
+    routes = {
+        "GET": [
+            (r"/api/records/?$", records),
+            (r"/api/deposit/depositions/?$", list_depositions),
+            (r"/api/deposit/depositions/(\d+)$", get_deposition),
+            (r"/api/deposit/depositions/(\d+)/files$", list_files),
+            (r"/files/([^/]+)$", bucket_get),
+        ],
+        "POST": [
+            (r"/api/deposit/depositions/?$", create),
+            (r"/api/deposit/depositions/(\d+)/actions/edit$", edit),
+            (r"/api/deposit/depositions/(\d+)/actions/publish$", publish),
+            (r"/api/deposit/depositions/(\d+)/actions/newversion$", new_version),
+        ],
+        "PUT": [
+            (r"/api/deposit/depositions/(\d+)$", put_deposition),
+            (r"/files/([^/]+)/(.+)$", bucket_put),
+        ],
+        "DELETE": [
+            (r"/api/deposit/depositions/(\d+)/files/([^/]+)$", delete_file),
+        ],
+    }
+
+
+class MockZenodo(object):
+    """local stand-in for the Zenodo server, run in a background thread -
+    every request is delayed by latency seconds, uploads are limited to
+    bandwidth bytes / second per stream and a fraction error_rate of requests
+    fail with 429 or 503. Use as a context manager; point a ZenodoClient at
+    the server attribute."""
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None, error_rate=0.0):
+        self._httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), MockZenodoHandler
+        )
+        self._httpd.daemon_threads = True
+        self._httpd.state = ZenodoState()
+        self._httpd.latency = latency
+        self._httpd.bandwidth = bandwidth
+        self._httpd.error_rate = error_rate
+        self.server = "http://127.0.0.1:%d" % self._httpd.server_address[1]
+        self._thread = None
+
+    @property
+    def state(self):
+        return self._httpd.state
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def mock_zenodo():
+    """main() - run the mock server until interrupted"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p", "--port", help="port to listen on", type=int, default=8765
+    )
+    parser.add_argument(
+        "--latency", help="seconds to delay each request", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--bandwidth", help="upload bytes / second per stream", type=float
+    )
+    parser.add_argument(
+        "--error-rate",
+        help="fraction of requests to fail with 429 / 503",
+        type=float,
+        default=0.0,
+    )
+    args = parser.parse_args()
+
+    mock = MockZenodo(args.port, args.latency, args.bandwidth, args.error_rate)
+    print("Mock Zenodo at %s" % mock.server)
+    try:
+        mock._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    mock_zenodo()
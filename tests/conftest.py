@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# the modules are scripts alongside one another, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_zenodo import MockZenodo
+from zenodo_client import ZenodoClient
+
+
+@pytest.fixture
+def mock():
+    with MockZenodo() as mock:
+        yield mock
+
+
+@pytest.fixture
+def client(mock):
+    client = ZenodoClient("token", server=mock.server, backoff=0.01)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def metadata():
+    def metadata(title="Test deposition"):
+        return {
+            "title": title,
+            "description": "test",
+            "creators": [{"name": "Public, Joe Q."}],
+            "keywords": ["test"],
+        }
+
+    return metadata
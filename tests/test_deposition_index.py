@@ -0,0 +1,60 @@
+import os
+
+from deposition_index import DepositionIndex
+from zenodo_uploader import ZenodoUploader
+
+
+def publish(client, metadata, tmp_path, title, index=None):
+    filename = tmp_path / "data"
+    filename.write_bytes(b"data")
+    uploader = ZenodoUploader(
+        [str(filename)], metadata(title), None, client=client, index=index
+    )
+    uploader.upload()
+    return uploader
+
+
+def test_refresh_finds_published_elsewhere(tmp_path, mock, client, metadata):
+    index = DepositionIndex(client, page_size=2)
+    index.refresh()
+    assert len(index) == 0
+
+    # by some other client, so not added to the index
+    for title in ("X1", "X2", "X3"):
+        publish(client, metadata, tmp_path, title)
+    # added to the index as published, newer than all of the above
+    for title in ("Y1", "Y2"):
+        publish(client, metadata, tmp_path, title, index)
+
+    index.refresh(force=True)
+    for title in ("X1", "X2", "X3", "Y1", "Y2"):
+        assert [d["title"] for d in index.find_title(title)] == [title]
+
+
+def test_drafts_not_found_by_title(tmp_path, mock, client, metadata):
+    index = DepositionIndex(client, ttl=0)
+    publish(client, metadata, tmp_path, "published")
+    draft = client.post("/api/deposit/depositions", "create", json={}).json()
+    client.put(
+        "/api/deposit/depositions/%d" % draft["id"],
+        "update",
+        json={"metadata": metadata("draft")},
+    )
+
+    assert len(index.find_title("published")) == 1
+    assert index.find_title("draft") == []
+    assert index.find_id(draft["id"])["title"] == "draft"
+
+
+def test_saved_and_loaded(tmp_path, mock, client, metadata):
+    filename = str(tmp_path / "index.json")
+    index = DepositionIndex(client, filename)
+    publish(client, metadata, tmp_path, "T", index)
+    index.save()
+    assert os.path.exists(filename)
+
+    # nothing fetched again within the ttl
+    requests = client.counters()["requests"]
+    index = DepositionIndex(client, filename)
+    assert [d["title"] for d in index.find_title("T")] == ["T"]
+    assert client.counters()["requests"] == requests
@@ -0,0 +1,191 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import zipfile
+
+import pytest
+
+from file_packing import HashingReader, ParallelGzipWriter, UploadBody, checksums
+from file_packing import packup_tar_gz, packup_zip, parallel_zip_supported
+from file_packing import ScratchSpace, pack_pipeline, shard_files, shard_name
+from file_scanning import FileEntry
+
+BLOCK = 1 << 20
+
+SIZES = {
+    "empty": 0,
+    "small": 1000,
+    "block": BLOCK,
+    "block+1": BLOCK + 1,
+    "two blocks": 2 * BLOCK,
+}
+
+
+@pytest.fixture
+def files(tmp_path):
+    """files of every size in SIZES, half compressible half random"""
+
+    files = []
+    for name, size in SIZES.items():
+        for kind in ("text", "random"):
+            filename = tmp_path / ("%s-%s" % (name.replace(" ", "_"), kind))
+            if kind == "text":
+                data = (b"zenodo uploader %d\n" * (size // 10 + 1))[:size]
+            else:
+                data = os.urandom(size)
+            filename.write_bytes(data)
+            files.append(str(filename))
+    return files
+
+
+def test_parallel_zip_supported():
+    assert parallel_zip_supported()
+
+
+@pytest.mark.parametrize("level", [None, 0, 1, 9])
+@pytest.mark.parametrize("jobs", [1, 4])
+@pytest.mark.parametrize("adaptive", [True, False])
+def test_zip_roundtrip(tmp_path, files, level, jobs, adaptive):
+    archive = str(tmp_path / "out.zip")
+    summary = packup_zip(archive, files, level=level, jobs=jobs, adaptive=adaptive)
+
+    with zipfile.ZipFile(archive) as fin:
+        assert fin.testzip() is None
+        assert sorted(fin.namelist()) == sorted(os.path.basename(f) for f in files)
+        for filename in files:
+            with open(filename, "rb") as f:
+                assert fin.read(os.path.basename(filename)) == f.read()
+    assert summary["deflated"] + summary["stored"] == len(files)
+    if not adaptive:
+        assert summary["stored"] == 0
+
+
+def test_zip_roundtrip_unseekable(tmp_path, files):
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.data = bytearray()
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            self.data += data
+            return len(data)
+
+    out = Unseekable()
+    packup_zip(out, files, jobs=4)
+    with zipfile.ZipFile(io.BytesIO(bytes(out.data))) as fin:
+        assert fin.testzip() is None
+
+
+@pytest.mark.parametrize("level", [None, 0, 9])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_tar_gz_roundtrip(tmp_path, files, level, jobs):
+    archive = str(tmp_path / "out.tar.gz")
+    packup_tar_gz(archive, files, level=level, jobs=jobs)
+
+    with tarfile.open(archive, "r:gz") as fin:
+        assert sorted(fin.getnames()) == sorted(os.path.basename(f) for f in files)
+        for filename in files:
+            with open(filename, "rb") as f:
+                assert fin.extractfile(os.path.basename(filename)).read() == f.read()
+
+
+@pytest.mark.parametrize("size", sorted(SIZES.values()))
+@pytest.mark.parametrize("write_size", [1, 4096, BLOCK, 3 * BLOCK])
+def test_parallel_gzip(size, write_size):
+    data = os.urandom(size // 2) + b"a" * (size - size // 2)
+    out = io.BytesIO()
+    gz = ParallelGzipWriter(out, level=6, jobs=4)
+    for j in range(0, size, write_size):
+        gz.write(data[j : j + write_size])
+    gz.close()
+    assert gzip.decompress(out.getvalue()) == data
+
+
+def test_upload_body_repeats_from_start(tmp_path):
+    filename = tmp_path / "data"
+    data = os.urandom(3 * BLOCK + 17)
+    filename.write_bytes(data)
+
+    with open(filename, "rb", buffering=0) as f:
+        f.read(5)
+        hasher = HashingReader(f)
+        body = UploadBody(hasher)
+        assert len(body) == len(data) - 5
+        for attempt in range(2):
+            assert b"".join(bytes(chunk) for chunk in body) == data[5:]
+            assert hasher.hexdigest() == hashlib.md5(data[5:]).hexdigest()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_checksums_errors(tmp_path, jobs):
+    here = tmp_path / "here"
+    here.write_bytes(b"here")
+    files = [str(here), str(tmp_path / "gone")]
+
+    with pytest.raises(OSError):
+        checksums(files, jobs=jobs)
+
+    errors = {}
+    digests = checksums(files, jobs=jobs, errors=errors)
+    assert digests == {str(here): hashlib.md5(b"here").hexdigest()}
+    assert list(errors) == [str(tmp_path / "gone")]
+
+
+def test_tar_gz_failure_stops_threads(tmp_path, files):
+    threads = threading.active_count()
+    with pytest.raises(OSError):
+        packup_tar_gz(
+            str(tmp_path / "out.tar.gz"), files + [str(tmp_path / "gone")], jobs=4
+        )
+    assert threading.active_count() == threads
+
+
+def test_shard_files():
+    sizes = [5, 5, 12, 1, 1, 1]
+    files = [FileEntry("f%d" % j, size=size) for j, size in enumerate(sizes)]
+
+    assert shard_files(files) == [files]
+    # in order, never splitting a file, one too big gets a shard of its own
+    assert shard_files(files, max_size=10) == [files[:2], files[2:3], files[3:]]
+    assert shard_files(files, max_files=4) == [files[:4], files[4:]]
+    assert shard_files(files, max_size=11, max_files=2) == [
+        files[:2],
+        files[2:3],
+        files[3:5],
+        files[5:],
+    ]
+
+    assert shard_name("data.zip", 1) == "data_001.zip"
+    assert shard_name("data.tar.gz", 12) == "data_012.tar.gz"
+
+
+def test_pack_pipeline_shards(tmp_path, files):
+    scratch = ScratchSpace()
+    archives = list(
+        pack_pipeline(
+            [("data.zip", files), ("small.tar.gz", files[:2])],
+            jobs=2,
+            scratch=scratch,
+            max_files=4,
+        )
+    )
+
+    archives.sort(key=lambda archive: os.path.split(archive)[-1])
+    names = [os.path.split(archive)[-1] for archive in archives]
+    assert names == ["data_001.zip", "data_002.zip", "data_003.zip", "small.tar.gz"]
+
+    members = []
+    for archive in archives:
+        if archive.endswith(".zip"):
+            with zipfile.ZipFile(archive) as z:
+                members.extend(z.namelist())
+    assert members == [os.path.split(f)[-1] for f in files]
+
+    for archive in archives:
+        scratch.remove(archive)
+        assert not os.path.exists(archive)
@@ -0,0 +1,66 @@
+import pytest
+
+from file_scanning import FileEntry, entry_arcname, entry_size, scan_files
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """top/{a.cbf, b.txt, sub/{c.cbf, tmp/d.cbf}, empty/}"""
+
+    top = tmp_path / "top"
+    for path in ("a.cbf", "b.txt", "sub/c.cbf", "sub/tmp/d.cbf"):
+        (top / path).parent.mkdir(parents=True, exist_ok=True)
+        (top / path).write_text(path)
+    (top / "empty").mkdir()
+    return top
+
+
+def arcnames(entries):
+    return sorted(entry.arcname for entry in entries)
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_scan(tree, jobs):
+    assert arcnames(scan_files(str(tree), jobs=jobs)) == ["a.cbf", "b.txt"]
+    assert arcnames(scan_files(str(tree), recursive=True, jobs=jobs)) == [
+        "a.cbf",
+        "b.txt",
+        "sub/c.cbf",
+        "sub/tmp/d.cbf",
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_scan_include_exclude(tree, jobs):
+    def scan(**kwargs):
+        return arcnames(scan_files(str(tree), recursive=True, jobs=jobs, **kwargs))
+
+    assert scan(include=("*.cbf",)) == ["a.cbf", "sub/c.cbf", "sub/tmp/d.cbf"]
+    # an excluded directory is not descended into
+    assert scan(include=("*.cbf",), exclude=("tmp",)) == ["a.cbf", "sub/c.cbf"]
+    # patterns match the path relative to the directory too
+    assert scan(exclude=("sub/*",)) == ["a.cbf", "b.txt"]
+
+
+def test_scan_entries(tree):
+    entries = list(scan_files(str(tree), recursive=True))
+    # each directory in name order, its files before those below it
+    assert [entry.arcname for entry in entries] == [
+        "a.cbf",
+        "b.txt",
+        "sub/c.cbf",
+        "sub/tmp/d.cbf",
+    ]
+    for entry in entries:
+        assert entry == str(tree / entry.arcname)
+        assert entry.size == len(entry.arcname)
+        assert entry.mtime_ns == (tree / entry.arcname).stat().st_mtime_ns
+        assert entry_arcname(entry) == entry.arcname
+        assert entry_size(entry) == entry.size
+
+
+def test_plain_paths(tree):
+    path = str(tree / "sub" / "c.cbf")
+    assert entry_arcname(path) == "c.cbf"
+    assert entry_size(path) == len("sub/c.cbf")
+    assert FileEntry(path).arcname == "c.cbf"
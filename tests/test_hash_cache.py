@@ -0,0 +1,83 @@
+import os
+
+import file_packing
+from file_packing import md5
+from hash_cache import HashCache
+
+
+def test_get_put(tmp_path):
+    filename = tmp_path / "data"
+    filename.write_bytes(b"data")
+    cache = HashCache(str(tmp_path / "cache.db"))
+
+    assert cache.get(str(filename)) is None
+    cache.put(str(filename), "digest")
+    assert cache.get(str(filename)) == "digest"
+    assert cache.get(str(filename), "sha1") is None
+
+    # kept between runs
+    cache.close()
+    cache = HashCache(str(tmp_path / "cache.db"))
+    assert cache.get(str(filename)) == "digest"
+
+
+def test_changed_file_invalidated(tmp_path):
+    filename = tmp_path / "data"
+    filename.write_bytes(b"data")
+    cache = HashCache(str(tmp_path / "cache.db"))
+    cache.put(str(filename), "digest")
+
+    # same size, new mtime
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get(str(filename)) is None
+
+    cache.put(str(filename), "digest")
+    filename.write_bytes(b"changed")
+    assert cache.get(str(filename)) is None
+
+    cache.put(str(filename), "digest")
+    cache.invalidate(str(filename))
+    assert cache.get(str(filename)) is None
+
+
+def test_least_recently_used_evicted(tmp_path):
+    files = []
+    for j in range(5):
+        filename = tmp_path / ("f%d" % j)
+        filename.write_bytes(b"%d" % j)
+        files.append(str(filename))
+    cache = HashCache(str(tmp_path / "cache.db"), max_entries=3, check_every=1)
+
+    for filename in files[:3]:
+        cache.put(filename, filename)
+    # f0 used since, so f1 is the oldest
+    assert cache.get(files[0]) == files[0]
+    cache.put(files[3], files[3])
+    assert [cache.get(f) is not None for f in files[:4]] == [
+        True,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_md5_cached(tmp_path, monkeypatch):
+    filename = tmp_path / "data"
+    filename.write_bytes(b"data")
+    cache = HashCache(str(tmp_path / "cache.db"))
+
+    read = []
+    checksum = file_packing.checksum
+    monkeypatch.setattr(
+        file_packing, "checksum", lambda *args: read.append(args) or checksum(*args)
+    )
+
+    digest = md5(str(filename), cache)
+    assert md5(str(filename), cache) == digest
+    assert len(read) == 1
+    assert cache.get(str(filename)) == digest
+
+    filename.write_bytes(b"changed")
+    assert md5(str(filename), cache) != digest
+    assert len(read) == 2
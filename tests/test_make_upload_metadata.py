@@ -0,0 +1,60 @@
+import csv
+import json
+
+from make_upload_metadata import make_upload_metadata
+
+
+def write_csv(filename, rows):
+    with open(filename, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def row(set_id, compound="compound", status="Deposited"):
+    return [set_id, "", "C1=CC=CC=C1", "", compound, status, "5R%s" % set_id[-2:]]
+
+
+def test_incremental(tmp_path):
+    csv_input = tmp_path / "sets.csv"
+    locations = tmp_path / "locations"
+    locations.write_text("/data/x01\n/data/X02\n/data/x03\n")
+    output = tmp_path / "out"
+    output.mkdir()
+
+    def make():
+        return make_upload_metadata(
+            str(csv_input),
+            str(locations),
+            output=str(output),
+            state=str(tmp_path / "state.db"),
+            manifest=str(tmp_path / "new"),
+            changed_manifest=str(tmp_path / "changed"),
+            jobs=2,
+        )
+
+    def listed(manifest):
+        return (tmp_path / manifest).read_text().split()
+
+    write_csv(csv_input, [row("x01"), row("x02"), row("x04"), row("x03", status="")])
+    made = make()
+    # no location for x04, x03 not deposited
+    assert sorted(made) == [str(output / "x01.json"), str(output / "x02.json")]
+    assert sorted(listed("new")) == made
+    assert listed("changed") == []
+    metadata = json.loads((output / "x02.json").read_text())
+    assert metadata["directory"] == ["/data/X02"]
+    assert metadata["archive"] == ["x02.zip"]
+
+    # nothing changed, nothing made
+    assert make() == []
+    assert listed("new") == listed("changed") == []
+
+    # one changed, one new
+    write_csv(csv_input, [row("x01", "other"), row("x02"), row("x03"), row("x04")])
+    assert sorted(make()) == [str(output / "x01.json"), str(output / "x03.json")]
+    assert listed("new") == [str(output / "x03.json")]
+    assert listed("changed") == [str(output / "x01.json")]
+    assert "other" in json.loads((output / "x01.json").read_text())["title"]
+
+    # a removed file is made again
+    (output / "x02.json").unlink()
+    assert make() == [str(output / "x02.json")]
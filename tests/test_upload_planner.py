@@ -0,0 +1,76 @@
+from file_scanning import FileEntry
+from upload_planner import pack_bins, plan_files, plan_uploads, print_plan
+
+
+def entries(*sizes):
+    return [FileEntry("/data/f%d" % j, "f%d" % j, size) for j, size in enumerate(sizes)]
+
+
+def test_pack_bins():
+    bins = pack_bins([5, 3, 8, 2, 4], lambda x: x, max_size=10)
+    # first fit decreasing, each bin keeping the original order
+    assert bins == [(10, [8, 2]), (9, [5, 4]), (3, [3])]
+
+    # bigger than the limit gets its own bin
+    assert pack_bins([20, 1], lambda x: x, max_size=10) == [(20, [20]), (1, [1])]
+    assert len(pack_bins([1] * 7, lambda x: x, max_count=3)) == 3
+
+
+def test_plan_files(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "x").write_text("x")
+
+    def scan(path):
+        return [FileEntry(str(path / "x"), "x", 1)]
+
+    assert plan_files(None, ["f1", "f2"], scan) == ["f1", "f2"]
+    (one,) = plan_files([tmp_path / "a"], None, scan)
+    assert one.arcname == "x"
+    found = plan_files([tmp_path / "a", tmp_path / "b"], None, scan)
+    assert [f.arcname for f in found] == ["a/x", "b/x"]
+    assert [f.size for f in found] == [1, 1]
+
+
+def test_plan_archives():
+    files = entries(6, 5, 4, 3, 2)
+    plan = plan_uploads(
+        files,
+        "data.zip",
+        max_archive_size=10,
+        max_deposition_size=12,
+        max_deposition_files=100,
+    )
+    archives = [upload for deposition in plan for upload in deposition]
+    assert sorted(name for name, contents in archives) == [
+        "data_001.zip",
+        "data_002.zip",
+    ]
+    assert sorted(f for name, contents in archives for f in contents) == files
+    # each deposition within its size limit
+    for deposition in plan:
+        assert sum(f.size for name, contents in deposition for f in contents) <= 12
+    assert len(plan) == 2
+
+
+def test_plan_one_archive_keeps_name():
+    plan = plan_uploads(entries(1, 2, 3), "data.tar.gz")
+    assert [[name for name, contents in d] for d in plan] == [["data.tar.gz"]]
+
+
+def test_plan_files_without_archive():
+    files = entries(*[1] * 5)
+    plan = plan_uploads(files, max_deposition_files=2)
+    assert [len(deposition) for deposition in plan] == [2, 2, 1]
+    assert [contents for deposition in plan for name, contents in deposition] == [
+        [f] for f in files
+    ]
+    assert plan[0][0][0] == "f0"
+
+
+def test_print_plan(capsys):
+    print_plan(plan_uploads(entries(2000000, 3000000), "data.zip"), 1000000)
+    out = capsys.readouterr().out
+    assert "Deposition 1 of 1: 1 uploads, 5.0 MB" in out
+    assert "Plan: 1 uploads in 1 depositions, 5.0 MB" in out
+    assert "Estimated transfer time: 0:00:05 at 1.0 MB/s" in out
@@ -0,0 +1,57 @@
+import argparse
+
+import pytest
+
+from zenodo_batch import list_metadata_files, add_deposit_arguments, deposit_setup
+from zenodo_uploader import add_upload_arguments
+
+
+def test_list_metadata_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("b.json", "a.json", "zenodo_batch.json", "index.json", "notes.txt"):
+        (tmp_path / name).write_text("{}")
+    (tmp_path / "manifest").write_text("m1.json\n\nm2.json\n")
+
+    assert list_metadata_files(
+        [str(tmp_path)], ["manifest"], exclude=("zenodo_batch.json", "index.json")
+    ) == ["m1.json", "m2.json", str(tmp_path / "a.json"), str(tmp_path / "b.json")]
+
+
+def test_deposit_arguments_are_the_uploader_arguments():
+    uploader = argparse.ArgumentParser()
+    add_upload_arguments(uploader)
+    batch = argparse.ArgumentParser()
+    add_deposit_arguments(batch)
+
+    argv = ["-r", "--include", "*.cbf", "-j", "3", "-x", "--shard-size", "2K"]
+    expected = vars(uploader.parse_args(argv))
+    expected["concurrency"] = 4
+    assert vars(batch.parse_args(argv)) == expected
+
+
+def test_deposit_setup(tmp_path):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-z", "--zenodo_id")
+    parser.add_argument("-s", "--sandbox", action="store_true")
+    add_deposit_arguments(parser)
+    args = parser.parse_args(
+        ["-z", "token", "-c", "3", "-j", "4", "--index", str(tmp_path / "index")]
+    )
+
+    client, metrics, kwargs = deposit_setup(args)
+    assert sorted(kwargs) == [
+        "cache",
+        "checksum",
+        "done",
+        "index",
+        "jobs",
+        "metrics",
+        "pack",
+        "pipeline",
+        "scan",
+    ]
+    assert kwargs["jobs"] == 4 and kwargs["metrics"] is metrics
+    assert kwargs["index"] is not None and kwargs["cache"] is None
+
+    with pytest.raises(SystemExit):
+        deposit_setup(parser.parse_args(["-z", "token", "--scan-jobs", "0"]))
@@ -0,0 +1,85 @@
+import email.utils
+import hashlib
+import os
+import time
+
+import pytest
+
+import mock_zenodo
+from file_packing import HashingReader, UploadBody
+from zenodo_client import retry_after
+
+
+class Response(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("5", 5.0),
+        ("-3", 0.0),
+        ("soon", None),
+        ("inf", None),
+        ("nan", None),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),
+    ],
+)
+def test_retry_after(value, expected):
+    assert retry_after(Response({"Retry-After": value})) == expected
+
+
+def test_retry_after_date():
+    when = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < retry_after(Response({"Retry-After": when})) <= 60
+
+    # no zone, read as GMT
+    when = time.strftime("%a, %d %b %Y %H:%M:%S", time.gmtime(time.time() + 60))
+    assert 55 < retry_after(Response({"Retry-After": when})) <= 60
+
+
+def test_retry_after_rate_limit():
+    headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "junk"}
+    assert retry_after(Response(headers)) is None
+    headers["X-RateLimit-Reset"] = str(time.time() + 30)
+    assert 25 < retry_after(Response(headers)) <= 30
+    assert retry_after(Response({})) is None
+
+
+class FailFirst(object):
+    """stands in for the random module of mock_zenodo, failing the first
+    request with 503 and no others"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def random(self):
+        self.calls += 1
+        return 0.0 if self.calls == 1 else 1.0
+
+    def choice(self, choices):
+        return 503
+
+
+def test_retried_put_checksum(tmp_path, mock, client, monkeypatch):
+    bucket = client.post("/api/deposit/depositions", "create", json={}).json()
+    bucket = bucket["links"]["bucket"]
+
+    filename = tmp_path / "data"
+    data = os.urandom((5 << 20) + 3)
+    filename.write_bytes(data)
+
+    mock._httpd.error_rate = 0.5
+    monkeypatch.setattr(mock_zenodo, "random", FailFirst())
+
+    with open(filename, "rb", buffering=0) as f:
+        hasher = HashingReader(f)
+        received = client.put(
+            "%s/data" % bucket, "upload", data=UploadBody(hasher)
+        ).json()
+
+    assert client.counters()["retried"] == 1
+    assert received["size"] == len(data)
+    assert hasher.hexdigest() == hashlib.md5(data).hexdigest()
+    assert received["checksum"] == "md5:%s" % hasher.hexdigest()
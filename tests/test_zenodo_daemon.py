@@ -0,0 +1,49 @@
+import json
+import os
+
+from file_packing import packup
+from zenodo_daemon import SpoolDaemon
+
+
+def write_metadata(filename, metadata, **files):
+    metadata.update(files)
+    with open(filename, "w") as f:
+        json.dump(metadata, f)
+
+
+def test_spool_daemon(tmp_path, mock, client, metadata):
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    data = tmp_path / "data"
+    data.write_bytes(b"x" * 1000)
+
+    write_metadata(spool / "good.json", metadata("Good"), files=[str(data)])
+    write_metadata(spool / "bad.json", metadata("Bad"))
+    # still being written, under another name
+    write_metadata(spool / "next.json.tmp", metadata("Next"), files=[str(data)])
+
+    daemon = SpoolDaemon(
+        str(spool),
+        str(tmp_path / "done"),
+        str(tmp_path / "failed"),
+        client,
+        concurrency=2,
+        pack=packup,
+    )
+
+    # nothing is taken until it is seen unchanged twice
+    assert daemon.poll() == 0
+    daemon.run(interval=0.01, once=True)
+
+    assert daemon.counts == {"done": 1, "failed": 1}
+    assert sorted(os.listdir(spool)) == ["next.json.tmp"]
+    assert os.listdir(tmp_path / "done") == ["good.json"]
+    assert sorted(os.listdir(tmp_path / "failed")) == ["bad.json", "bad.json.error"]
+    assert (
+        "must pass some files" in (tmp_path / "failed" / "bad.json.error").read_text()
+    )
+
+    (deposition,) = mock.state.depositions.values()
+    assert deposition["submitted"]
+    assert deposition["metadata"]["title"] == "Good"
+    assert list(mock.state.buckets[deposition["bucket"]]) == ["data"]
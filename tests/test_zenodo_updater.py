@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import pytest
+
+from zenodo_updater import ZenodoUpdater, bulk_metadata, bulk_update
+from zenodo_uploader import ZenodoUploader
+
+
+@pytest.fixture
+def published(tmp_path, client, metadata):
+    """a deposition of files a, b and c - return the directory they are in"""
+
+    directory = tmp_path / "v1"
+    directory.mkdir()
+    for name in "abc":
+        (directory / name).write_bytes(name.encode())
+    files = sorted(str(f) for f in directory.iterdir())
+    ZenodoUploader(files, metadata(), None, client=client).upload()
+    return directory
+
+
+def bucket(mock, dep_id):
+    deposition = mock.state.depositions[dep_id]
+    return {
+        key: f["checksum"]
+        for key, f in mock.state.buckets[deposition["bucket"]].items()
+    }
+
+
+def test_new_version(tmp_path, mock, client, metadata, published):
+    (published / "b").write_bytes(b"b changed")
+    (published / "c").unlink()
+    (published / "d").write_bytes(b"d")
+    files = sorted(str(f) for f in published.iterdir())
+
+    updater = ZenodoUpdater({"title": metadata()["title"]}, None, client=client)
+    assert updater.new_version(files, hash_jobs=1)
+
+    first, second = sorted(mock.state.depositions)
+    assert mock.state.depositions[second]["submitted"]
+    assert sorted(bucket(mock, first)) == ["a", "b", "c"]
+    assert sorted(bucket(mock, second)) == ["a", "b", "d"]
+    assert bucket(mock, second)["a"] == bucket(mock, first)["a"]
+    assert bucket(mock, second)["b"] != bucket(mock, first)["b"]
+
+
+def test_new_version_unchanged(tmp_path, mock, client, metadata, published):
+    files = sorted(str(f) for f in published.iterdir())
+
+    updater = ZenodoUpdater({"title": metadata()["title"]}, None, client=client)
+    assert not updater.new_version(files, hash_jobs=1)
+
+    # no draft left behind
+    assert len(mock.state.depositions) == 1
+
+
+def test_mock_rejects_same_files(mock, client, metadata, published):
+    (dep_id,) = mock.state.depositions
+    client.post("/api/deposit/depositions/%d/actions/newversion" % dep_id, "new")
+    with pytest.raises(RuntimeError, match="HTTP status 400"):
+        client.post("/api/deposit/depositions/%d/actions/publish" % (dep_id + 1), "p")
+
+
+def test_bulk_update(tmp_path, mock, client, metadata):
+    for title in ("A", "B"):
+        filename = tmp_path / title
+        filename.write_bytes(title.encode())
+        ZenodoUploader([str(filename)], metadata(title), None, client=client).upload()
+
+    b = metadata("B")
+    b.update(description="new B", files=["ignored"])
+    (tmp_path / "b.json").write_text(json.dumps(b))
+    (tmp_path / "patch.json").write_text(
+        json.dumps({"A": {"description": "new A"}, "C": {"description": "new C"}})
+    )
+
+    updates = bulk_metadata([str(tmp_path / "b.json")], str(tmp_path / "patch.json"))
+    assert [u["title"] for u in updates] == ["B", "A", "C"]
+    assert "files" not in updates[0]
+
+    updaters = [ZenodoUpdater(u, None, client=client) for u in updates]
+    results = asyncio.run(bulk_update(updaters, concurrency=2))
+
+    assert [(title, error is None) for title, deposition, error in results] == [
+        ("B", True),
+        ("A", True),
+        ("C", False),
+    ]
+    descriptions = {
+        d["metadata"]["title"]: d["metadata"]["description"]
+        for d in mock.state.depositions.values()
+    }
+    assert descriptions == {"A": "new A", "B": "new B"}
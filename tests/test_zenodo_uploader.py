@@ -0,0 +1,135 @@
+import functools
+import os
+import threading
+import time
+
+import pytest
+
+from deposition_index import DepositionIndex
+from file_packing import ScratchSpace, pack_pipeline, packup
+from upload_journal import UploadJournal
+from zenodo_uploader import ZenodoUploader, iter_uploads
+
+
+class FailingUploader(ZenodoUploader):
+    """fails to upload anything named in fail"""
+
+    fail = ()
+
+    async def _upload(self, filename):
+        if os.path.basename(str(filename)) in self.fail:
+            raise RuntimeError("in upload: simulated failure")
+        await super()._upload(filename)
+
+
+def make_files(directory, count, size=1000):
+    files = []
+    for j in range(count):
+        filename = directory / ("f%d" % j)
+        filename.write_bytes(os.urandom(size))
+        files.append(str(filename))
+    return files
+
+
+def run_in_thread(function, timeout=30):
+    """run function in a thread, return the exception it raised - fail if
+    it is still running after timeout seconds"""
+
+    raised = []
+
+    def run():
+        try:
+            function()
+        except Exception as e:
+            raised.append(e)
+        else:
+            raised.append(None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "hung"
+    return raised[0]
+
+
+@pytest.mark.parametrize("with_index", [False, True])
+def test_journal_resume(tmp_path, mock, client, metadata, with_index):
+    files = make_files(tmp_path, 3)
+    journal = str(tmp_path / "journal")
+    index = DepositionIndex(client) if with_index else None
+
+    uploader = FailingUploader(
+        files,
+        metadata(),
+        None,
+        client=client,
+        journal=UploadJournal(journal),
+        index=index,
+    )
+    uploader.fail = ("f1",)
+    with pytest.raises(RuntimeError, match="1 of 3 files failed"):
+        uploader.upload()
+    assert UploadJournal(journal).deposition()
+
+    uploader = ZenodoUploader(
+        files,
+        metadata(),
+        None,
+        client=client,
+        journal=UploadJournal(journal),
+        index=index,
+    )
+    uploader.upload()
+
+    assert not os.path.exists(journal)
+    (deposition,) = mock.state.depositions.values()
+    assert deposition["submitted"]
+    assert sorted(mock.state.buckets[deposition["bucket"]]) == ["f0", "f1", "f2"]
+
+    # now published, the title is taken
+    with pytest.raises(RuntimeError, match="1 matches to title"):
+        ZenodoUploader(files, metadata(), None, client=client, index=index).upload()
+
+
+def test_failed_archive_frees_scratch(tmp_path, mock, client, metadata):
+    directories = []
+    for j in range(3):
+        directory = tmp_path / ("d%d" % j)
+        directory.mkdir()
+        make_files(directory, 1, 100000)
+        directories.append(str(directory))
+
+    # room for one archive at a time
+    scratch = ScratchSpace(150000)
+    pipeline = functools.partial(pack_pipeline, jobs=2, scratch=scratch)
+    uploads = iter_uploads(
+        directories, None, ["a0.zip", "a1.zip", "a2.zip"], packup, pipeline=pipeline
+    )
+    uploader = FailingUploader(
+        uploads, metadata(), None, client=client, done=scratch.remove
+    )
+    uploader.fail = ("a0.zip",)
+
+    error = run_in_thread(uploader.upload)
+    assert isinstance(error, RuntimeError)
+    assert "1 of 3 files failed" in str(error)
+    (bucket,) = mock.state.buckets.values()
+    assert sorted(bucket) == ["a1.zip", "a2.zip"]
+
+
+def test_uploads_finish_before_error(tmp_path, mock, client, metadata):
+    (filename,) = make_files(tmp_path, 1, 200000)
+    mock._httpd.bandwidth = 400000
+
+    def files():
+        yield filename
+        time.sleep(0.1)
+        raise ValueError("packing failed")
+
+    uploader = ZenodoUploader(files(), metadata(), None, client=client, jobs=2)
+    with pytest.raises(ValueError, match="packing failed"):
+        uploader.upload()
+
+    # the upload under way was finished, not left running
+    (bucket,) = mock.state.buckets.values()
+    assert list(bucket) == ["f0"]
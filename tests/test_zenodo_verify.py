@@ -0,0 +1,87 @@
+import asyncio
+
+import zenodo_verify
+from zenodo_uploader import ZenodoUploader
+from zenodo_verify import verify
+
+
+def test_verify(tmp_path, mock, client, metadata):
+    here = tmp_path / "here.bin"
+    here.write_bytes(b"here")
+    changed = tmp_path / "changed.bin"
+    changed.write_bytes(b"before")
+    for title, files in (("ok", [here]), ("changed", [here, changed])):
+        files = [str(f) for f in files]
+        ZenodoUploader(files, metadata(title), None, client=client).upload()
+    changed.write_bytes(b"after")
+
+    results = asyncio.run(
+        verify(
+            [
+                ("ok", {"here.bin": str(here)}),
+                ("changed", {"changed.bin": str(changed)}),
+                ("gone", {"gone.bin": "/nonexistent/gone.bin"}),
+                ("archive", None),
+            ],
+            client,
+            hash_jobs=1,
+        )
+    )
+    ok, mismatch, gone, skipped = results
+
+    assert ok["state"] == "ok"
+    assert mismatch["state"] == "mismatch"
+    assert mismatch["extra"] == ["here.bin"]
+    assert [m["file"] for m in mismatch["mismatched"]] == [str(changed)]
+    assert gone["state"] == "error"
+    assert skipped["state"] == "skipped"
+
+
+def test_verify_missing_local_file(tmp_path, mock, client, metadata):
+    """a local file which cannot be read is an error for its deposition"""
+
+    here = tmp_path / "here.bin"
+    here.write_bytes(b"here")
+    ZenodoUploader([str(here)], metadata("T"), None, client=client).upload()
+
+    results = asyncio.run(
+        verify(
+            [
+                ("T", {"here.bin": str(here)}),
+                ("T", {"here.bin": str(here), "gone.bin": "/nonexistent/gone.bin"}),
+            ],
+            client,
+            hash_jobs=1,
+        )
+    )
+
+    assert [r["state"] for r in results] == ["ok", "error"]
+    assert "gone.bin" in results[1]["error"]
+    assert results[1]["deposition"] == results[0]["deposition"]
+
+
+def test_verify_hashes_in_one_pass(tmp_path, mock, client, metadata, monkeypatch):
+    """the files of every deposition are checksummed together, in parallel"""
+
+    depositions = []
+    for j in range(4):
+        filename = tmp_path / ("f%d" % j)
+        filename.write_bytes(b"%d" % j)
+        ZenodoUploader(
+            [str(filename)], metadata("T%d" % j), None, client=client
+        ).upload()
+        depositions.append(("T%d" % j, {filename.name: str(filename)}))
+    depositions.append(("T0", {"f0": str(tmp_path / "f0"), "gone": "/nonexistent"}))
+
+    calls = []
+    original = zenodo_verify.checksums
+
+    def checksums(files, *args, **kwargs):
+        calls.append(sorted(files))
+        return original(files, *args, **kwargs)
+
+    monkeypatch.setattr(zenodo_verify, "checksums", checksums)
+
+    results = asyncio.run(verify(depositions, client, hash_jobs=2))
+    assert [r["state"] for r in results] == ["ok"] * 4 + ["error"]
+    assert len(calls) == 1
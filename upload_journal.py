@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+
+class UploadJournal(object):
+    """local record of a deposition in progress - the deposition id, bucket
+    URL and each file which finished uploading - so that an interrupted
+    upload can carry on with the same draft. Rewritten (atomically) on every
+    change, removed once the deposition is published."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                self._journal = json.load(f)
+        else:
+            self._journal = {"deposition": None, "bucket": None, "uploaded": {}}
+
+    def _write(self):
+        tmp = "%s.tmp" % self._filename
+        with open(tmp, "w") as f:
+            json.dump(self._journal, f, indent=1)
+        os.replace(tmp, self._filename)
+
+    def deposition(self):
+        """(deposition id, bucket URL) of the draft in progress, or None"""
+
+        if self._journal["deposition"] is None:
+            return None
+        return self._journal["deposition"], self._journal["bucket"]
+
+    def start(self, dep_id, bucket):
+        with self._lock:
+            self._journal = {"deposition": dep_id, "bucket": bucket, "uploaded": {}}
+            self._write()
+
+    def uploaded(self, key, size, checksum=None):
+        with self._lock:
+            self._journal["uploaded"][key] = {"size": size, "checksum": checksum}
+            self._write()
+
+    def get_uploaded(self):
+        """dictionary of file name: {size, checksum} for files uploaded"""
+
+        return dict(self._journal["uploaded"])
+
+    def finish(self):
+        with self._lock:
+            if os.path.exists(self._filename):
+                os.remove(self._filename)
@@ -0,0 +1,127 @@
+import os
+
+from file_packing import shard_name
+from file_scanning import FileEntry, entry_size
+
+# what Zenodo accepts in one record - at most 100 files, 50 GB in total
+ZENODO_MAX_FILES = 100
+ZENODO_MAX_SIZE = 50 * 1000**3
+
+
+def pack_bins(items, size, max_size=None, max_count=None):
+    """bin-pack items into as few lists as possible of at most max_count
+    items totalling at most max_size by size(item) - first fit decreasing,
+    so the biggest items are placed first. An item bigger than max_size gets
+    a bin to itself. Return a list of (total size, items) with the items of
+    each in their original order."""
+
+    order = {id(item): j for j, item in enumerate(items)}
+    bins = []
+    for item in sorted(items, key=size, reverse=True):
+        item_size = size(item)
+        for contents in bins:
+            if max_count and len(contents[1]) >= max_count:
+                continue
+            if max_size and contents[0] + item_size > max_size:
+                continue
+            contents[0] += item_size
+            contents[1].append(item)
+            break
+        else:
+            bins.append([item_size, [item]])
+
+    return [
+        (total, sorted(contents, key=lambda item: order[id(item)]))
+        for total, contents in bins
+    ]
+
+
+def plan_files(directory, files, scan):
+    """every file to plan for - files as given, or those found in each
+    directory by scan, named in archives relative to their directory (and
+    under its name if there are several, so they cannot clash)"""
+
+    if files:
+        return list(files)
+
+    found = []
+    for path in directory:
+        for entry in scan(path):
+            if len(directory) > 1:
+                name = os.path.split(os.path.normpath(path))[-1]
+                entry = FileEntry(
+                    entry, "%s/%s" % (name, entry.arcname), entry.size, entry.mtime_ns
+                )
+            found.append(entry)
+    return found
+
+
+def plan_uploads(
+    files,
+    archive_name=None,
+    max_archive_size=None,
+    max_archive_files=None,
+    max_deposition_size=ZENODO_MAX_SIZE,
+    max_deposition_files=ZENODO_MAX_FILES,
+):
+    """split files between as few depositions as possible within the limits
+    - with archive_name, first pack them into as few archives as possible,
+    numbered if more than one, each also within the deposition size - return
+    a list of depositions, each a list of (upload name, files) where files is
+    a single file unless an archive"""
+
+    if archive_name:
+        limit = min(filter(None, (max_archive_size, max_deposition_size)), default=None)
+        archives = pack_bins(files, entry_size, limit, max_archive_files)
+        names = [archive_name]
+        if len(archives) > 1:
+            names = [shard_name(archive_name, j + 1) for j in range(len(archives))]
+        uploads = [
+            (total, (name, contents))
+            for name, (total, contents) in zip(names, archives)
+        ]
+    else:
+        uploads = [(entry_size(f), (os.path.split(f)[-1], [f])) for f in files]
+
+    depositions = pack_bins(
+        uploads,
+        lambda upload: upload[0],
+        max_deposition_size,
+        max_deposition_files,
+    )
+    return [[upload for total, upload in contents] for total, contents in depositions]
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def print_plan(plan, bandwidth=None):
+    """show what will be uploaded where, with the total bytes and (given the
+    bandwidth in bytes / second) how long it should take"""
+
+    total = 0
+    for j, deposition in enumerate(plan):
+        size = sum(entry_size(f) for name, files in deposition for f in files)
+        total += size
+        print(
+            "Deposition %d of %d: %d uploads, %.1f MB"
+            % (j + 1, len(plan), len(deposition), size / 1.0e6)
+        )
+        for name, files in deposition:
+            print(
+                "  %-40s %8d files %12.1f MB"
+                % (name, len(files), sum(map(entry_size, files)) / 1.0e6)
+            )
+
+    uploads = sum(map(len, plan))
+    print(
+        "Plan: %d uploads in %d depositions, %.1f MB"
+        % (uploads, len(plan), total / 1.0e6)
+    )
+    if bandwidth:
+        print(
+            "Estimated transfer time: %s at %.1f MB/s"
+            % (format_duration(total / bandwidth), bandwidth / 1.0e6)
+        )
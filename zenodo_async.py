@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import functools
+import json
+
+
+class AsyncZenodoClient(object):
+    """asyncio interface to the Zenodo deposit API, one coroutine per
+    operation - each request runs on a worker thread through the shared
+    (blocking) ZenodoClient, so its pooled connections, rate limit and
+    retries still apply, while any number of depositions can be worked on
+    from one event loop. Use as an async context manager; workers is the
+    most requests in flight at once."""
+
+    def __init__(self, client, workers=10):
+        self.client = client
+        self.server = client.server
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        """wait for the requests in flight to finish"""
+
+        self._executor.shutdown(wait=True)
+
+    async def run(self, function, *args, **kwargs):
+        """run a blocking function on a worker thread, return the result"""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def _json(self, method, path, what, **kwargs):
+        r = await self.run(self.client.request, method, path, what, **kwargs)
+        return r.json()
+
+    async def search(self, title: str, size: int = 2) -> dict:
+        """published records with this title - the hits, with the total"""
+
+        result = await self._json(
+            "GET",
+            "/api/records/",
+            "find",
+            params={"page": 1, "size": size, "q": 'title:"%s"' % title},
+        )
+        return result["hits"]
+
+    async def create(self) -> dict:
+        """new empty draft deposition"""
+
+        return await self._json(
+            "POST",
+            "/api/deposit/depositions",
+            "create",
+            json={},
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def get(self, dep_id: int, what: str = "get") -> dict:
+        return await self._json("GET", "/api/deposit/depositions/%s" % dep_id, what)
+
+    async def update_metadata(self, dep_id: int, metadata: dict) -> dict:
+        """replace the metadata of a draft (or edited) deposition, return the
+        deposition"""
+
+        return await self._json(
+            "PUT",
+            "/api/deposit/depositions/%s" % dep_id,
+            "update",
+            data=json.dumps({"metadata": metadata}),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def upload_file(self, bucket: str, key: str, data) -> dict:
+        """PUT data (bytes, open file or iterable of chunks) to bucket as key,
+        return what Zenodo has for it - key, size and checksum"""
+
+        return await self._json("PUT", "%s/%s" % (bucket, key), "upload", data=data)
+
+    async def bucket_contents(self, bucket: str, what: str = "list") -> list:
+        """files in bucket, each with key, size and checksum"""
+
+        result = await self._json("GET", bucket, what)
+        return result["contents"]
+
+    async def list_files(self, dep_id: int) -> list:
+        """files of a deposition, each with id, filename, filesize and the md5
+        checksum"""
+
+        return await self._json(
+            "GET", "/api/deposit/depositions/%s/files" % dep_id, "list"
+        )
+
+    async def delete_file(self, dep_id: int, file_id: str) -> None:
+        """remove a file from a draft deposition"""
+
+        await self.run(
+            self.client.delete,
+            "/api/deposit/depositions/%s/files/%s" % (dep_id, file_id),
+            "delete",
+        )
+
+    async def new_version(self, dep_id: int) -> dict:
+        """new draft version of a published deposition, starting with the same
+        metadata and files - return the draft"""
+
+        deposition = await self._json(
+            "POST",
+            "/api/deposit/depositions/%s/actions/newversion" % dep_id,
+            "newversion",
+        )
+        draft = deposition["links"]["latest_draft"]
+        return await self._json("GET", draft, "newversion")
+
+    async def edit(self, dep_id: int) -> dict:
+        """unlock a published deposition for changes"""
+
+        return await self._json(
+            "POST", "/api/deposit/depositions/%s/actions/edit" % dep_id, "edit"
+        )
+
+    async def publish(self, dep_id: int) -> dict:
+        return await self._json(
+            "POST", "/api/deposit/depositions/%s/actions/publish" % dep_id, "publish"
+        )
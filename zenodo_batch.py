@@ -0,0 +1,246 @@
+#!/usr/bin/env dials.python
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+
+from file_scanning import scan_files
+from metadata import validate_metadata, read_metadata
+from upload_journal import UploadJournal
+from zenodo_uploader import ZenodoUploader, split_metadata, check_upload
+from zenodo_uploader import list_uploads, iter_uploads
+from zenodo_uploader import add_upload_arguments, check_upload_arguments, upload_setup
+
+
+class BatchStatus(object):
+    """persistent record of the state of each deposition in a batch, keyed
+    on metadata file name - rewritten (atomically) on every change so that a
+    batch can be stopped and restarted"""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                self._status = json.load(f)
+        else:
+            self._status = {}
+
+    def done(self, metadata_file):
+        return self._status.get(metadata_file, {}).get("state") == "done"
+
+    def set(self, metadata_file, state, **kwargs):
+        with self._lock:
+            self._status[metadata_file] = dict(state=state, **kwargs)
+            tmp = "%s.tmp" % self._filename
+            with open(tmp, "w") as f:
+                json.dump(self._status, f, indent=1)
+            os.replace(tmp, self._filename)
+
+    def summary(self):
+        counts = {}
+        for record in self._status.values():
+            counts[record["state"]] = counts.get(record["state"], 0) + 1
+        return counts
+
+
+def list_metadata_files(paths, manifests=None, exclude=()):
+    """metadata files listed in each manifest (one per line), then those in
+    paths - files, or directories of JSON files other than those in exclude
+    (e.g. the batch status file, which may be kept alongside)"""
+
+    skip = set(os.path.abspath(f) for f in exclude if f)
+
+    metadata_files = []
+    for manifest in manifests or ():
+        with open(manifest) as f:
+            metadata_files.extend(line.strip() for line in f if line.strip())
+    for path in paths:
+        if os.path.isdir(path):
+            metadata_files.extend(
+                f
+                for f in sorted(scan_files(path, include=("*.json",)))
+                if os.path.abspath(f) not in skip
+            )
+        else:
+            metadata_files.append(path)
+    return metadata_files
+
+
+def deposit(
+    metadata_file,
+    client,
+    pack,
+    scan=scan_files,
+    pipeline=None,
+    jobs=1,
+    checksum=False,
+    cache=None,
+    index=None,
+    metrics=None,
+    done=None,
+):
+    """upload the deposition described by metadata_file, return the URL -
+    progress is journaled alongside so an interrupted deposition resumes.
+    With pipeline, archives are packed while uploading; done is called with
+    each upload once complete."""
+
+    metadata = read_metadata(metadata_file)
+    directory, files, archive = split_metadata(metadata)
+    check_upload(directory, files, archive)
+    validate_metadata(metadata)
+
+    if pipeline is not None and archive:
+        uploads = iter_uploads(directory, files, archive, pack, scan, pipeline)
+    else:
+        uploads = list_uploads(directory, files, archive, pack, scan)
+
+    made = []
+
+    def track(uploads):
+        for upload in uploads:
+            made.append(upload)
+            yield upload
+
+    zenodo_uploader = ZenodoUploader(
+        track(uploads),
+        metadata,
+        None,
+        jobs=jobs,
+        client=client,
+        checksum=checksum,
+        journal=UploadJournal("%s.journal" % metadata_file),
+        cache=cache,
+        index=index,
+        metrics=metrics,
+        done=done,
+    )
+    try:
+        zenodo_uploader.upload()
+    except Exception:
+        # the archives of a failed deposition will be packed afresh when it
+        # is resumed - free their space for the rest of the batch
+        if done is not None:
+            for upload in made:
+                done(upload)
+        raise
+    return zenodo_uploader.get_deposition()
+
+
+def run_batch(metadata_files, status, client, concurrency=4, **kwargs):
+    """deposit every metadata file not already done according to status, at
+    most concurrency at a time - kwargs are passed to deposit()"""
+
+    todo = [m for m in metadata_files if not status.done(m)]
+    print(
+        "%d depositions, %d already done"
+        % (len(metadata_files), len(metadata_files) - len(todo))
+    )
+
+    def run(metadata_file):
+        status.set(metadata_file, "running")
+        try:
+            deposition = deposit(metadata_file, client, **kwargs)
+        except Exception as e:
+            status.set(metadata_file, "failed", error=str(e))
+            print("Failed: %s (%s)" % (metadata_file, e))
+        else:
+            status.set(metadata_file, "done", deposition=deposition)
+            print("Done: %s -> %s" % (metadata_file, deposition))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, todo))
+
+    return status.summary()
+
+
+def add_deposit_arguments(parser):
+    """add the options for how to deposit (shared by zenodo_batch.py and
+    zenodo_daemon.py) to parser - those of zenodo_uploader.py, applied to
+    every deposition, and how many depositions to make at once"""
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="number of depositions to make at once",
+        type=int,
+        default=4,
+    )
+    add_upload_arguments(parser)
+
+
+def deposit_setup(args):
+    """check the deposit options, then make what is shared by every deposition
+    - return the client, the metrics and the keyword arguments for deposit()"""
+
+    if args.concurrency < 1:
+        sys.exit("concurrency must be at least 1")
+    check_upload_arguments(args)
+
+    # one client for the whole batch, with a connection for every upload
+    return upload_setup(args, pool_size=max(10, args.concurrency * args.jobs))
+
+
+def batch():
+    """main() - parse args, deposit every metadata file given"""
+
+    parser = argparse.ArgumentParser()
+
+    # zenodo / administrative matters
+    parser.add_argument("-z", "--zenodo_id", help="zenodo upload key")
+    parser.add_argument("-s", "--sandbox", help="use sandbox mode", action="store_true")
+
+    parser.add_argument(
+        "metadata", nargs="*", help="json metadata files, or directories of them"
+    )
+    parser.add_argument(
+        "--manifest",
+        help="file listing metadata files one per line, e.g. from "
+        "make_upload_metadata.py --manifest",
+        action="append",
+    )
+    parser.add_argument(
+        "--status",
+        help="file to record batch progress in (default: zenodo_batch.json)",
+        default="zenodo_batch.json",
+    )
+    add_deposit_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.metadata and not args.manifest:
+        sys.exit("must pass some metadata files or a manifest")
+
+    # not the files this batch writes, if they are among the metadata
+    metadata_files = list_metadata_files(
+        args.metadata, args.manifest, exclude=(args.status, args.index, args.metrics)
+    )
+
+    client, metrics, kwargs = deposit_setup(args)
+
+    summary = run_batch(
+        metadata_files,
+        BatchStatus(args.status),
+        client,
+        concurrency=args.concurrency,
+        **kwargs
+    )
+    metrics.close(client.counters())
+    if kwargs["index"] is not None:
+        kwargs["index"].save()
+
+    metrics.report()
+    client.report()
+    print(
+        "Batch complete: %s"
+        % ", ".join("%d %s" % (summary[state], state) for state in sorted(summary))
+    )
+
+    if summary.get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    batch()
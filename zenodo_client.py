@@ -0,0 +1,280 @@
+import datetime
+import email.utils
+import math
+import os
+import pprint
+import random
+import threading
+import time
+
+import requests
+import requests.adapters
+
+# methods which can safely be repeated if the outcome of a request is unknown
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE")
+
+# responses worth trying again - rate limited, or transient server trouble
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def get_access_token(sandbox=False):
+    """get upload key, strip white space."""
+
+    if sandbox:
+        return open(os.path.join(os.environ["HOME"], ".sandbox_id"), "r").read().strip()
+    else:
+        return open(os.path.join(os.environ["HOME"], ".zenodo_id"), "r").read().strip()
+
+
+class RateLimiter(object):
+    """client side token bucket allowing rate requests per second on average
+    (unlimited if None) in bursts of up to burst, which can also be paused
+    when the server asks for requests to stop for a while"""
+
+    def __init__(self, rate=None, burst=None):
+        self._rate = rate
+        self._burst = burst or max(1.0, rate or 1.0)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """no more requests for seconds"""
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        """wait for permission to make a request, return True if had to"""
+
+        with self._lock:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if self._rate:
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._last) * self._rate
+                )
+                self._last = now
+                # take the token now, so concurrent callers queue behind
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self._rate)
+
+        if wait > 0:
+            time.sleep(wait)
+            return True
+        return False
+
+
+def retry_after(r):
+    """seconds the server asked us to wait before trying again, from the
+    Retry-After header (seconds or HTTP date) or the rate limit headers if
+    the limit is used up, else None - also if the header makes no sense"""
+
+    value = r.headers.get("Retry-After")
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                # not a number or a date - ignore it rather than fail
+                return None
+            if when.tzinfo is None:
+                # HTTP dates are GMT
+                when = when.replace(tzinfo=datetime.timezone.utc)
+            seconds = when.timestamp() - time.time()
+        if not math.isfinite(seconds):
+            return None
+        return max(0.0, seconds)
+
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+        reset = r.headers.get("X-RateLimit-Reset")
+        try:
+            reset = float(reset)
+        except (TypeError, ValueError):
+            return None
+        if math.isfinite(reset):
+            return max(0.0, reset - time.time())
+
+    return None
+
+
+def _rewind(data):
+    """prepare the body of a request to be sent again - return a function to
+    do so, or None if this is not possible (e.g. a generator)"""
+
+    if data is None or isinstance(data, (bytes, str, dict)):
+        return lambda: None
+    if hasattr(data, "seek") and hasattr(data, "tell"):
+        position = data.tell()
+        return lambda: data.seek(position)
+    if not hasattr(data, "read") and iter(data) is not data:
+        # an iterable which starts again each time it is iterated
+        return lambda: None
+    return None
+
+
+class ZenodoClient(object):
+    """shared HTTP layer for the Zenodo REST API - one pooled keep-alive
+    session for every call, with the access token added to each request.
+
+    All requests pass through a rate limiter; rate limited (429) and
+    transient server error responses are retried with jittered exponential
+    backoff, honouring Retry-After - idempotent requests are also retried on
+    connection errors. server overrides the Zenodo (or sandbox) URL, e.g. to
+    point at a local mock_zenodo."""
+
+    def __init__(
+        self,
+        token,
+        sandbox=False,
+        pool_size=10,
+        rate=None,
+        retries=5,
+        backoff=1.0,
+        max_backoff=60.0,
+        server=None,
+    ):
+
+        self._token = token
+        self._limiter = RateLimiter(rate)
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._counters = {"requests": 0, "throttled": 0, "retried": 0, "failed": 0}
+        self._counters_lock = threading.Lock()
+        if server:
+            self.server = server
+        elif sandbox:
+            self.server = "https://sandbox.zenodo.org"
+        else:
+            self.server = "https://zenodo.org"
+
+        # one adapter for both schemes so that connections are reused across
+        # every deposition handled by this client - pool_size should be at
+        # least the number of threads sharing the client
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def url(self, path):
+        """expand a path on the server to a full URL, leave full URLs alone"""
+
+        if path.startswith("/"):
+            return "%s%s" % (self.server, path)
+        return path
+
+    def _count(self, counter):
+        with self._counters_lock:
+            self._counters[counter] += 1
+
+    def counters(self):
+        """number of requests made, throttled (delayed by the client or
+        rate limited by the server), retried, and failed outright"""
+
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def report(self):
+        counters = self.counters()
+        print(
+            "HTTP requests: %d (%d throttled, %d retried, %d failed)"
+            % (
+                counters["requests"],
+                counters["throttled"],
+                counters["retried"],
+                counters["failed"],
+            )
+        )
+
+    def _delay(self, attempt, r=None):
+        """how long to wait before the next attempt - at least what the
+        server asked for, else exponential backoff with full jitter"""
+
+        delay = random.uniform(0, min(self._max_backoff, self._backoff * 2**attempt))
+        if r is not None:
+            wait = retry_after(r)
+            if wait is not None:
+                delay = max(delay, wait)
+        return delay
+
+    def request(self, method, path, what, **kwargs):
+        """make an authenticated request, raise RuntimeError naming the
+        operation what if the response is not a success"""
+
+        params = dict(kwargs.pop("params", None) or {})
+        params["access_token"] = self._token
+        rewind = _rewind(kwargs.get("data"))
+
+        attempt = 0
+        while True:
+            if self._limiter.acquire():
+                self._count("throttled")
+            self._count("requests")
+
+            try:
+                r = self._session.request(
+                    method, self.url(path), params=params, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if method not in IDEMPOTENT or rewind is None:
+                    raise
+                if attempt >= self._retries:
+                    self._count("failed")
+                    raise
+                delay = self._delay(attempt)
+                print("Retrying %s in %.1fs: %s" % (what, delay, e))
+            else:
+                # the server may tell us to slow down even on success
+                wait = retry_after(r)
+                if wait:
+                    self._limiter.pause(wait)
+
+                retry = r.status_code in RETRY_STATUS and rewind is not None
+                if r.status_code != 429 and method not in IDEMPOTENT:
+                    retry = False
+                if r.status_code == 429:
+                    self._count("throttled")
+                if not retry or attempt >= self._retries:
+                    break
+                delay = self._delay(attempt, r)
+                print(
+                    "Retrying %s in %.1fs: HTTP status %d"
+                    % (what, delay, r.status_code)
+                )
+
+            self._count("retried")
+            time.sleep(delay)
+            rewind()
+            attempt += 1
+
+        if not r.status_code in (200, 201, 202, 204):
+            self._count("failed")
+            try:
+                pprint.pprint(r.json())
+            except ValueError:
+                print(r.text)
+            raise RuntimeError("in %s: HTTP status %d" % (what, r.status_code))
+
+        return r
+
+    def get(self, path, what, **kwargs):
+        return self.request("GET", path, what, **kwargs)
+
+    def post(self, path, what, **kwargs):
+        return self.request("POST", path, what, **kwargs)
+
+    def put(self, path, what, **kwargs):
+        return self.request("PUT", path, what, **kwargs)
+
+    def delete(self, path, what, **kwargs):
+        return self.request("DELETE", path, what, **kwargs)
+
+    def close(self):
+        self._session.close()
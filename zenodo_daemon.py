@@ -0,0 +1,191 @@
+#!/usr/bin/env dials.python
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+
+from file_scanning import scan_files
+from zenodo_batch import deposit, add_deposit_arguments, deposit_setup
+
+
+class SpoolDaemon(object):
+    """watch a spool directory for metadata files (as for zenodo_batch.py)
+    and deposit each one as it arrives, on a pool of concurrency workers
+    sharing one client - so the token is read and connections are opened
+    once, not for every deposition. Finished metadata files are moved to
+    done, failed ones (with their journal, to resume, and the error) to
+    failed; moving them back into the spool tries again. kwargs are passed
+    to deposit()."""
+
+    def __init__(
+        self, spool, done_directory, failed_directory, client, concurrency=4, **kwargs
+    ):
+        for directory in (spool, done_directory, failed_directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self._spool = spool
+        self._done = done_directory
+        self._failed = failed_directory
+        self._client = client
+        self._kwargs = kwargs
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._seen = {}
+        self._stop = threading.Event()
+        self.counts = {"done": 0, "failed": 0}
+
+    def _move(self, metadata_file, directory):
+        """move metadata_file and anything alongside it (journal) to directory,
+        return the new path"""
+
+        name = os.path.split(metadata_file)[-1]
+        for suffix in ("", ".journal"):
+            if os.path.exists(metadata_file + suffix):
+                shutil.move(
+                    metadata_file + suffix, os.path.join(directory, name + suffix)
+                )
+        return os.path.join(directory, name)
+
+    def _run(self, metadata_file):
+        if not os.path.exists(metadata_file):
+            # queued again by a poll which listed it just before it was moved
+            with self._lock:
+                self._queued.discard(metadata_file)
+            return
+
+        try:
+            deposition = deposit(metadata_file, self._client, **self._kwargs)
+        except Exception as e:
+            moved = self._move(metadata_file, self._failed)
+            with open("%s.error" % moved, "w") as f:
+                f.write("%s\n" % e)
+            print("Failed: %s (%s)" % (metadata_file, e))
+            state = "failed"
+        else:
+            self._move(metadata_file, self._done)
+            print("Done: %s -> %s" % (metadata_file, deposition))
+            state = "done"
+
+        with self._lock:
+            self._queued.discard(metadata_file)
+            self.counts[state] += 1
+
+    def poll(self):
+        """queue every metadata file in the spool which has not changed since
+        the last poll (so is no longer being written) and is not already
+        queued - return the number queued"""
+
+        seen = {}
+        queued = 0
+        for metadata_file in scan_files(self._spool, include=("*.json",)):
+            seen[metadata_file] = (metadata_file.size, metadata_file.mtime_ns)
+            if self._seen.get(metadata_file) != seen[metadata_file]:
+                continue
+            with self._lock:
+                if metadata_file in self._queued:
+                    continue
+                self._queued.add(metadata_file)
+            print("Queued: %s" % metadata_file)
+            self._pool.submit(self._run, str(metadata_file))
+            queued += 1
+        self._seen = seen
+        return queued
+
+    def busy(self):
+        with self._lock:
+            return bool(self._queued)
+
+    def run(self, interval=5.0, once=False):
+        """poll every interval seconds until stop() - with once, only until
+        the spool has been emptied - then finish the depositions in progress,
+        leaving any not yet started in the spool for next time"""
+
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                if once and not self.busy() and not self._seen:
+                    break
+                self._stop.wait(interval)
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def stop(self, *args):
+        self._stop.set()
+
+
+def daemon():
+    """main() - parse args, deposit metadata files as they arrive in the
+    spool directory"""
+
+    parser = argparse.ArgumentParser()
+
+    # zenodo / administrative matters
+    parser.add_argument("-z", "--zenodo_id", help="zenodo upload key")
+    parser.add_argument("-s", "--sandbox", help="use sandbox mode", action="store_true")
+
+    parser.add_argument("spool", help="directory to watch for json metadata files")
+    parser.add_argument(
+        "--done",
+        help="directory to move deposited metadata files to (default spool/done)",
+    )
+    parser.add_argument(
+        "--failed",
+        help="directory to move failed metadata files to (default spool/failed)",
+    )
+    parser.add_argument(
+        "--interval",
+        help="seconds between looks at the spool directory (default 5)",
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--once",
+        help="exit once the spool directory is empty",
+        action="store_true",
+    )
+    add_deposit_arguments(parser)
+    args = parser.parse_args()
+
+    client, metrics, kwargs = deposit_setup(args)
+
+    spool_daemon = SpoolDaemon(
+        args.spool,
+        args.done or os.path.join(args.spool, "done"),
+        args.failed or os.path.join(args.spool, "failed"),
+        client,
+        concurrency=args.concurrency,
+        **kwargs
+    )
+
+    # finish the depositions in progress on the way out
+    signal.signal(signal.SIGTERM, spool_daemon.stop)
+    signal.signal(signal.SIGINT, spool_daemon.stop)
+
+    print("Watching %s" % args.spool)
+    t0 = time.time()
+    try:
+        spool_daemon.run(args.interval, once=args.once)
+    finally:
+        metrics.close(client.counters())
+        if kwargs["index"] is not None:
+            kwargs["index"].save()
+
+    metrics.report()
+    client.report()
+    print(
+        "Stopped after %.0fs: %d done, %d failed"
+        % (time.time() - t0, spool_daemon.counts["done"], spool_daemon.counts["failed"])
+    )
+
+    if args.once and spool_daemon.counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    daemon()
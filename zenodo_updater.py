@@ -1,59 +1,77 @@
 #!/usr/bin/env dials.python
 
 import argparse
-import requests
+import asyncio
 import os
 import sys
 import json
 import pprint
-import urllib
 
+from file_packing import checksums, UploadBody
+from file_scanning import scan_files
+from hash_cache import HashCache
 from metadata import make_metadata, read_metadata
+from zenodo_client import ZenodoClient, get_access_token
+from zenodo_async import AsyncZenodoClient
+from deposition_index import DepositionIndex
 
 
-def get_access_token(sandbox=False):
-    """get upload key, strip white space."""
+async def find_deposition(api, title, index=None):
+    """the one published deposition with this title - from the deposition
+    index if there is one, else with a search through the AsyncZenodoClient
+    api - raise RuntimeError unless exactly one is found"""
 
-    if sandbox:
-        return open(os.path.join(os.environ["HOME"], ".sandbox_id"), "r").read().strip()
+    if index is not None:
+        hits = await api.run(index.find_title, title)
+        total = len(hits)
     else:
-        return open(os.path.join(os.environ["HOME"], ".zenodo_id"), "r").read().strip()
+        result = await api.search(title)
+        hits = result["hits"]
+        total = result["total"]
+
+    if not total == 1:
+        raise RuntimeError("%d results found for %s" % (total, title))
+    return hits[0]
+
+
+def diff_files(local, digests, remote):
+    """compare local files (upload key: file, with md5 digests by file) with
+    the files of a deposition - return the sorted keys of those removed,
+    added and changed"""
+
+    remote = {f["filename"]: f for f in remote}
+    removed = sorted(set(remote) - set(local))
+    added = sorted(set(local) - set(remote))
+    changed = sorted(
+        key
+        for key in set(local) & set(remote)
+        if remote[key]["checksum"] != digests[local[key]]
+    )
+    return removed, added, changed
 
 
 class ZenodoUpdater(object):
     """tool to upload files to http://zenodo.org"""
 
-    def __init__(self, metadata, token, sandbox=False):
+    def __init__(self, metadata, token, sandbox=False, client=None, index=None):
+
+        if client is None:
+            client = ZenodoClient(token, sandbox=sandbox)
 
         self._metadata = metadata
-        self._token = token
+        self._client = client
+        self._index = index
         self._dep_id = None
         self._dep_url = None
         self._dep_metadata = None
-        if sandbox:
-            self._server = "https://sandbox.zenodo.org"
-        else:
-            self._server = "https://zenodo.org"
-
-    def _find(self):
-        """find this deposition"""
-
-        title = self._metadata["title"]
-
-        r = requests.get(
-            '%s/api/records/?page=1&size=2&q=title:"%s"'
-            % (self._server, urllib.parse.quote(title))
-        )
-
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in find: HTTP status %d" % r.status_code)
+        self._server = client.server
+        self._api = None
 
-        response = r.json()["hits"]
+    async def _find(self):
+        """find this deposition - from the deposition index if there is one,
+        else with a search"""
 
-        if not response["total"] == 1:
-            raise RuntimeError("%d results found for %s" % (response["total"], title))
-        result = response["hits"][0]
+        result = await find_deposition(self._api, self._metadata["title"], self._index)
 
         self._dep_id = result["id"]
         self._dep_url = "%s/api/deposit/depositions/%d" % (self._server, result["id"])
@@ -61,8 +79,8 @@ class ZenodoUpdater(object):
 
         print("Located deposition: id = %d" % self._dep_id)
 
-    def _update(self):
-        """push the metadata for this deposition"""
+    def _merged_metadata(self):
+        """the metadata of the deposition with the updates applied"""
 
         # first merge update metadata with existing metadata - will
         # overwrite existing values where updates exist
@@ -89,66 +107,201 @@ class ZenodoUpdater(object):
         communities = [{"identifier": "covid-19"}, {"identifier": "mx"}]
         metadata["communities"] = communities
 
-        metadata = {"metadata": metadata}
-        metadata["metadata"].update({"access_right": "open", "upload_type": "dataset"})
+        metadata.update({"access_right": "open", "upload_type": "dataset"})
 
-        pprint.pprint(metadata["metadata"])
+        return metadata
 
-        # switch to edit mode
-        r = requests.post(
-            "%s/api/deposit/depositions/%s/actions/edit" % (self._server, self._dep_id),
-            params={"access_token": self._token},
-        )
+    async def _update(self, edit=True):
+        """push the metadata for this deposition - switching it to edit mode
+        first, unless a draft"""
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in edit: HTTP status %d" % r.status_code)
+        metadata = self._merged_metadata()
 
-        r = requests.put(
-            "%s/api/deposit/depositions/%s" % (self._server, self._dep_id),
-            params={"access_token": self._token},
-            data=json.dumps(metadata),
-            headers={"Content-Type": "application/json"},
-        )
+        pprint.pprint(metadata)
+
+        # switch to edit mode
+        if edit:
+            await self._api.edit(self._dep_id)
+
+        deposition = await self._api.update_metadata(self._dep_id, metadata)
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in update: HTTP status %d" % r.status_code)
+        if self._index is not None:
+            self._index.add(deposition)
 
         print("Uploaded metadata for: %s" % (self._metadata["title"]))
 
-    def _publish(self):
+    async def _publish(self):
         """complete the deposition process"""
 
-        r = requests.post(
-            "%s/api/deposit/depositions/%s/actions/publish"
-            % (self._server, self._dep_id),
-            params={"access_token": self._token},
-        )
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in publish: HTTP status %d" % r.status_code)
+        deposition = await self._api.publish(self._dep_id)
+
+        if self._index is not None:
+            self._index.add(deposition)
 
         # FIXME grab the DOI from here
 
         print("Update published")
 
-    def update(self):
+    async def update_async(self):
         """process metadata for update"""
 
         # FIXME wrap this in a try except
 
-        self._find()
-        self._update()
-        self._publish()
+        # one request at a time for each deposition
+        async with AsyncZenodoClient(self._client, 1) as self._api:
+            await self._find()
+            await self._update()
+            await self._publish()
 
         # and in the except, delete the partial upload as it is broken
         # - particularly to catch Ctrl-C
 
+    def update(self):
+        """update_async, for callers outside an event loop"""
+
+        asyncio.run(self.update_async())
+
+    async def _upload(self, bucket, filename, digest):
+        """upload filename to bucket, check Zenodo received what was sent"""
+
+        key = os.path.split(filename)[-1]
+        print("Uploading: %s" % filename)
+        with open(filename, "rb", buffering=0) as fin:
+            received = await self._api.upload_file(bucket, key, UploadBody(fin))
+        if received.get("checksum") != "md5:%s" % digest:
+            raise RuntimeError(
+                "in upload: checksum mismatch for %s: sent md5:%s, Zenodo has %s"
+                % (filename, digest, received.get("checksum"))
+            )
+        print("Upload complete: %s" % filename)
+
+    async def new_version_async(self, files, jobs=1, hash_jobs=None, cache=None):
+        """make a new version of this deposition holding just files - only
+        those new or changed since the last version (by md5, computed across
+        hash_jobs processes or from the HashCache cache) are uploaded, jobs
+        at a time, and those no longer present deleted; the metadata is
+        updated as for update(). Return False, making no new version, if the
+        files are the same as the last version."""
+
+        local = {}
+        for filename in files:
+            key = os.path.split(filename)[-1]
+            if key in local:
+                raise ValueError(
+                    "%s and %s would both be uploaded as %s"
+                    % (local[key], filename, key)
+                )
+            local[key] = filename
+
+        # before touching the deposition, so nothing is left half done if a
+        # file cannot be read
+        digests = checksums(list(local.values()), "md5", jobs=hash_jobs, cache=cache)
+
+        async with AsyncZenodoClient(self._client, jobs + 1) as self._api:
+            await self._find()
+
+            # Zenodo will not publish a version with the same files as the
+            # last, so check there is a difference before making the draft
+            published = await self._api.list_files(self._dep_id)
+            if not any(diff_files(local, digests, published)):
+                print(
+                    "Files unchanged: no new version of %s made"
+                    % self._metadata["title"]
+                )
+                return False
+
+            draft = await self._api.new_version(self._dep_id)
+            self._dep_id = draft["id"]
+            self._dep_url = draft["links"]["self"]
+            print("New version: id = %d" % self._dep_id)
+
+            # a draft already in progress may differ from the last version
+            remote = {}
+            for f in await self._api.list_files(self._dep_id):
+                remote[f["filename"]] = f
+            removed, added, changed = diff_files(local, digests, remote.values())
+            print(
+                "Files: %d unchanged, %d changed, %d new, %d removed"
+                % (
+                    len(local) - len(added) - len(changed),
+                    len(changed),
+                    len(added),
+                    len(removed),
+                )
+            )
+
+            slots = asyncio.Semaphore(jobs)
+
+            async def delete(key):
+                async with slots:
+                    await self._api.delete_file(self._dep_id, remote[key]["id"])
+                print("Deleted: %s" % key)
+
+            # changed files are replaced, so go first
+            await asyncio.gather(*[delete(key) for key in removed + changed])
+
+            async def upload(key):
+                async with slots:
+                    await self._upload(
+                        draft["links"]["bucket"], local[key], digests[local[key]]
+                    )
+
+            await asyncio.gather(*[upload(key) for key in changed + added])
+
+            await self._update(edit=False)
+            await self._publish()
+
+        return True
+
+    def new_version(self, files, jobs=1, hash_jobs=None, cache=None):
+        """new_version_async, for callers outside an event loop"""
+
+        return asyncio.run(self.new_version_async(files, jobs, hash_jobs, cache))
+
     def get_deposition(self):
         return "%s/deposit/%s" % (self._server, self._dep_id)
 
 
+async def bulk_update(updaters, concurrency=8):
+    """run the find / edit / put / publish sequence of every ZenodoUpdater
+    in list concurrently, at most concurrency at once - return a list of
+    (title, deposition, error) with one of deposition or error None"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def update(zenodo_updater):
+        title = zenodo_updater._metadata["title"]
+        async with semaphore:
+            try:
+                await zenodo_updater.update_async()
+            except Exception as e:
+                return title, None, str(e)
+        return title, zenodo_updater.get_deposition(), None
+
+    return await asyncio.gather(*[update(u) for u in updaters])
+
+
+def bulk_metadata(metadata_files=(), patch_file=None):
+    """list of metadata updates to apply, one per deposition, from metadata
+    files and / or a JSON file mapping title: {metadata to change}"""
+
+    updates = []
+
+    for metadata_file in metadata_files:
+        metadata = read_metadata(metadata_file)
+        for key in ("directory", "files", "archive"):
+            metadata.pop(key, None)
+        updates.append(metadata)
+
+    if patch_file:
+        for title, patch in read_metadata(patch_file).items():
+            metadata = dict(patch)
+            metadata["title"] = title
+            updates.append(metadata)
+
+    return updates
+
+
 def updater():
     """main() - parse args, make Zenodo updater, execute, catch errors"""
 
@@ -169,8 +322,100 @@ def updater():
     )
     parser.add_argument("-K", "--keyword", help="keyword to associate", action="append")
     parser.add_argument("-D", "--description", help="description")
+    parser.add_argument(
+        "--pool-size", help="number of HTTP connections to keep open", type=int
+    )
+    parser.add_argument(
+        "--rate", help="maximum API requests per second to make", type=float
+    )
+    parser.add_argument(
+        "--retries",
+        help="times to retry rate limited or failed requests (default 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--index",
+        help="file to cache an index of the account's depositions in, for "
+        "title lookups",
+    )
+
+    # bulk updates - many depositions at once
+    parser.add_argument(
+        "-b", "--bulk", help="json metadata files to update from", nargs="+"
+    )
+    parser.add_argument(
+        "-P", "--patch", help="json file mapping title to metadata to update"
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="number of depositions to update at once in bulk mode",
+        type=int,
+        default=8,
+    )
+    parser.add_argument("--report", help="json file to write bulk results to")
+
+    # new versions - replace the files, sending only those which changed
+    parser.add_argument(
+        "--new-version",
+        help="make a new version of the deposition with the files given, "
+        "uploading only new or changed files and deleting those not given",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--directory",
+        help="directory of files for the new version",
+        action="append",
+    )
+    parser.add_argument("files", nargs="*", help="files for the new version")
+    parser.add_argument(
+        "-r",
+        "--recursive",
+        help="include files in subdirectories of each directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--include",
+        help="only take files from directories matching glob e.g. '*.cbf'",
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="skip files and subdirectories matching glob",
+        action="append",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of files to upload concurrently",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--hash-jobs",
+        help="number of processes to checksum with (default: one per CPU)",
+        type=int,
+    )
+    parser.add_argument(
+        "--hash-cache",
+        help="SQLite file to cache checksums of unchanged files in",
+    )
     args = parser.parse_args()
 
+    if args.bulk or args.patch:
+        if args.new_version:
+            sys.exit("--new-version applies to one deposition at a time")
+        return bulk_updater(args)
+
+    if args.new_version and not (args.directory or args.files):
+        sys.exit("--new-version needs the files for the new version")
+    if (args.directory or args.files) and not args.new_version:
+        sys.exit("files are only given for --new-version")
+    if args.jobs < 1:
+        sys.exit("number of upload jobs must be at least 1")
+
     # validate metadata - allow file read and update from command line
     # (with that priority)
     if args.metadata:
@@ -204,9 +449,124 @@ def updater():
     pprint.pprint(metadata)
 
     # make and act on
-    zenodo_updater = ZenodoUpdater(metadata, args.zenodo_id, args.sandbox)
-    zenodo_updater.update()
-    print("Update complete for deposition %s" % str(zenodo_updater.get_deposition()))
+    client = ZenodoClient(
+        args.zenodo_id,
+        sandbox=args.sandbox,
+        pool_size=args.pool_size or max(10, args.jobs),
+        rate=args.rate,
+        retries=args.retries,
+    )
+    if args.index:
+        index = DepositionIndex(client, args.index)
+    else:
+        index = None
+
+    zenodo_updater = ZenodoUpdater(
+        metadata, args.zenodo_id, args.sandbox, client=client, index=index
+    )
+    if args.new_version:
+        files = list(args.files)
+        for directory in args.directory or ():
+            files.extend(
+                scan_files(
+                    directory,
+                    recursive=args.recursive,
+                    include=args.include or (),
+                    exclude=args.exclude or (),
+                )
+            )
+        try:
+            made = zenodo_updater.new_version(
+                files,
+                jobs=args.jobs,
+                hash_jobs=args.hash_jobs,
+                cache=args.hash_cache and HashCache(args.hash_cache),
+            )
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        zenodo_updater.update()
+        made = True
+    if index is not None:
+        index.save()
+    client.report()
+    if made:
+        print(
+            "Update complete for deposition %s" % str(zenodo_updater.get_deposition())
+        )
+
+
+def bulk_updater(args):
+    """update many depositions concurrently, applying any metadata from the
+    command line to all of them, and report the results"""
+
+    if args.metadata or args.title:
+        sys.exit("-m / -T do not apply to bulk updates")
+    if args.concurrency < 1:
+        sys.exit("concurrency must be at least 1")
+
+    if not args.zenodo_id:
+        args.zenodo_id = get_access_token(sandbox=args.sandbox)
+
+    cl_metadata = make_metadata(
+        None, args.description, args.creator, args.affiliation, args.keyword
+    )
+
+    updates = bulk_metadata(args.bulk or (), args.patch)
+    for metadata in updates:
+        metadata.update(cl_metadata)
+
+    client = ZenodoClient(
+        args.zenodo_id,
+        sandbox=args.sandbox,
+        pool_size=args.pool_size or max(10, args.concurrency),
+        rate=args.rate,
+        retries=args.retries,
+    )
+    if args.index:
+        index = DepositionIndex(client, args.index)
+    else:
+        index = None
+
+    updaters = [
+        ZenodoUpdater(
+            metadata, args.zenodo_id, args.sandbox, client=client, index=index
+        )
+        for metadata in updates
+    ]
+
+    results = asyncio.run(bulk_update(updaters, concurrency=args.concurrency))
+
+    if index is not None:
+        index.save()
+
+    client.report()
+
+    failed = [result for result in results if result[2] is not None]
+
+    for title, deposition, error in results:
+        if error is None:
+            print("Updated: %s -> %s" % (title, deposition))
+        else:
+            print("Failed: %s (%s)" % (title, error))
+    print(
+        "Bulk update complete: %d updated, %d failed"
+        % (len(results) - len(failed), len(failed))
+    )
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                [
+                    {"title": title, "deposition": deposition, "error": error}
+                    for title, deposition, error in results
+                ],
+                f,
+                indent=1,
+            )
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,60 @@
 #!/usr/bin/env dials.python
 
 import argparse
-import requests
+import asyncio
+import functools
 import os
 import sys
-import json
-import pprint
 
-from file_packing import packup, md5
+from file_packing import packup, pack_pipeline, checksums, ArchiveStream, HashingReader
+from file_packing import ScratchSpace, UploadBody
+from file_packing import CHECKSUM_ALGORITHMS
+from file_scanning import scan_files
+from upload_planner import plan_files, plan_uploads, print_plan
+from upload_planner import ZENODO_MAX_FILES, ZENODO_MAX_SIZE
+from zenodo_client import ZenodoClient, get_access_token
+from zenodo_async import AsyncZenodoClient
+from upload_journal import UploadJournal
+from hash_cache import HashCache
+from deposition_index import DepositionIndex
+from metrics import Metrics, ProgressReader, ProgressIterable, METRICS_FORMATS
 from metadata import validate_metadata, print_metadata, make_metadata, read_metadata
 
 
-def get_access_token(sandbox=False):
-    """get upload key, strip white space."""
+def upload_name(upload):
+    """name to report for an upload - a file path or an ArchiveStream"""
 
-    if sandbox:
-        return open(os.path.join(os.environ["HOME"], ".sandbox_id"), "r").read().strip()
-    else:
-        return open(os.path.join(os.environ["HOME"], ".zenodo_id"), "r").read().strip()
+    if isinstance(upload, ArchiveStream):
+        return upload.name
+    return upload
+
+
+def upload_key(upload):
+    """name of an upload in the deposition bucket"""
+
+    if isinstance(upload, ArchiveStream):
+        return upload.name
+    return os.path.split(upload)[-1]
 
 
 class ZenodoUploader(object):
     """tool to upload files to http://zenodo.org"""
 
-    def __init__(self, file_list, metadata, token, sandbox=False):
+    def __init__(
+        self,
+        file_list,
+        metadata,
+        token,
+        sandbox=False,
+        jobs=1,
+        client=None,
+        checksum=False,
+        journal=None,
+        cache=None,
+        index=None,
+        metrics=None,
+        done=None,
+    ):
 
         # validate the structure of the metadata - there will be critical
         # items which must be present for this to be a useful deposition
@@ -42,123 +73,600 @@ class ZenodoUploader(object):
 
         metadata["metadata"].update({"access_right": "open", "upload_type": "dataset"})
 
+        if client is None:
+            client = ZenodoClient(token, sandbox=sandbox, pool_size=max(10, jobs))
+        if metrics is None:
+            metrics = Metrics()
+
         self._file_list = file_list
         self._metadata = metadata
-        self._token = token
+        self._client = client
         self._dep_id = None
         self._dep_url = None
-        if sandbox:
-            self._server = "https://sandbox.zenodo.org"
+        self._jobs = jobs
+        self._checksum = checksum
+        self._journal = journal
+        self._cache = cache
+        self._index = index
+        self._metrics = metrics
+        # called with each upload once it is in the bucket (or has failed),
+        # e.g. to remove a temporary archive
+        self._done = done
+        self._bucket_files = {}
+        self._server = client.server
+        self._api = None
+
+    async def _find(self):
+        """find this deposition - from the deposition index if there is one,
+        else with a search"""
+
+        title = self._metadata["metadata"]["title"]
+
+        if self._index is not None:
+            total = len(await self._api.run(self._index.find_title, title))
         else:
-            self._server = "https://zenodo.org"
+            total = (await self._api.search(title))["total"]
 
-        # before we do anything, check to see if it exists
-        self._find()
+        if total > 0:
+            raise RuntimeError("%d matches to title %s" % (total, title))
 
-    def _find(self):
-        """find this deposition"""
+    async def _create(self):
+        """create new empty deposition"""
 
-        title = self._metadata["title"]
+        deposition = await self._api.create()
+        self._dep_id = deposition["id"]
+        self._dep_url = deposition["links"]["bucket"]
 
-        r = requests.get(
-            '%s/api/records/?page=1&size=2&q=title:"%s"'
-            % (self._server, urllib.parse.quote(title))
-        )
+        if self._journal is not None:
+            self._journal.start(self._dep_id, self._dep_url)
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in find: HTTP status %d" % r.status_code)
+        print("Created deposition: id = %s" % self._dep_id)
 
-        response = r.json()["hits"]
+    async def _resume(self):
+        """carry on with the draft deposition recorded in the journal, and
+        find out which files its bucket already holds"""
 
-        if response["total"] > 0:
-            raise RuntimeError("%d matches to title %s" % (response["total"], title))
+        self._dep_id, self._dep_url = self._journal.deposition()
 
-    def _create(self):
-        """create new empty deposition"""
-        r = requests.post(
-            "%s/api/deposit/depositions" % self._server,
-            params={"access_token": self._token},
-            json={},
-            headers={"Content-Type": "application/json"},
-        )
+        deposition = await self._api.get(self._dep_id, "resume")
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in create: HTTP status %d" % r.status_code)
+        if deposition.get("submitted"):
+            raise RuntimeError(
+                "in resume: deposition %s already published" % self._dep_id
+            )
 
-        r_json = r.json()
-        self._dep_id = r_json["id"]
-        self._dep_url = r_json["links"]["bucket"]
+        contents = await self._api.bucket_contents(self._dep_url, "resume")
+        self._bucket_files = {f["key"]: f for f in contents}
 
-        print("Created deposition: id = %s" % self._dep_id)
+        print(
+            "Resuming deposition: id = %s (%d files present)"
+            % (self._dep_id, len(self._bucket_files))
+        )
 
-    def _update(self):
+    def _uploaded(self, upload):
+        """is this upload already complete in the bucket of a resumed draft?
+        Trust the journal where it has a record, else compare the cached md5
+        if there is one, else compare sizes"""
+
+        key = upload_key(upload)
+        remote = self._bucket_files.get(key)
+        if remote is None:
+            return False
+
+        done = self._journal.get_uploaded().get(key)
+        if done is not None:
+            return done["size"] == remote["size"] and done["checksum"] in (
+                None,
+                remote.get("checksum"),
+            )
+        if isinstance(upload, ArchiveStream):
+            return False
+        if self._cache is not None:
+            digest = self._cache.get(upload, "md5")
+            if digest is not None:
+                return "md5:%s" % digest == remote.get("checksum")
+        return os.path.getsize(upload) == remote["size"]
+
+    async def _update(self):
         """push the metadata for this deposition"""
 
-        r = requests.put(
-            "%s/api/deposit/depositions/%s" % (self._server, self._dep_id),
-            params={"access_token": self._token},
-            data=json.dumps(self._metadata),
-            headers={"Content-Type": "application/json"},
+        deposition = await self._api.update_metadata(
+            self._dep_id, self._metadata["metadata"]
         )
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in update: HTTP status %d" % r.status_code)
+        if self._index is not None:
+            self._index.add(deposition)
 
         print("Uploaded metadata for: %s" % (self._metadata["metadata"]["title"]))
 
-    def _upload(self, filename):
-        """upload file using stream API"""
-
-        print("Uploading: %s" % filename)
-
-        with open(filename, "rb") as fin:
-            r = requests.put(
-                "%s/%s" % (self._dep_url, os.path.split(filename)[-1]),
-                data=fin,
-                params={"access_token": self._token},
-            )
+    async def _upload(self, filename):
+        """upload file using stream API - filename may also be an ArchiveStream
+        in which case the archive is built as it is sent. If checksumming,
+        the md5 is computed from the data as sent and compared with the
+        checksum Zenodo reports for the received file."""
+
+        name = upload_name(filename)
+        print("Uploading: %s" % name)
+
+        key = upload_key(filename)
+
+        transferred = self._metrics.transferred
+        with self._metrics.phase("upload", name) as event:
+            if isinstance(filename, ArchiveStream):
+                hasher = filename
+                received = await self._api.upload_file(
+                    self._dep_url, key, ProgressIterable(filename, transferred)
+                )
+            else:
+                stat = os.stat(filename)
+                with open(filename, "rb", buffering=0) as fin:
+                    if self._checksum:
+                        fin = hasher = HashingReader(fin)
+                    received = await self._api.upload_file(
+                        self._dep_url, key, UploadBody(ProgressReader(fin, transferred))
+                    )
+            event["bytes"] = received.get("size") or 0
+
+        if self._checksum:
+            checksum = "md5:%s" % hasher.hexdigest()
+            if received.get("checksum") != checksum:
+                raise RuntimeError(
+                    "in upload: checksum mismatch for %s: sent %s, Zenodo has %s"
+                    % (name, checksum, received.get("checksum"))
+                )
+            if self._cache is not None and not isinstance(filename, ArchiveStream):
+                self._cache.put(filename, hasher.hexdigest(), "md5", stat)
+            print("Upload complete: %s %s" % (name, checksum))
+        else:
+            print("Upload complete: %s" % name)
 
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in upload: HTTP status %d" % r.status_code)
+        if self._journal is not None:
+            self._journal.uploaded(key, received.get("size"), received.get("checksum"))
 
-        print("Upload complete")
+        if self._done is not None:
+            self._done(filename)
 
-    def _publish(self):
+    async def _publish(self):
         """complete the deposition process"""
 
-        r = requests.post(
-            "%s/api/deposit/depositions/%s/actions/publish"
-            % (self._server, self._dep_id),
-            params={"access_token": self._token},
-        )
-        if not r.status_code in (200, 201, 202):
-            pprint.pprint(r.json())
-            raise RuntimeError("in publish: HTTP status %d" % r.status_code)
+        deposition = await self._api.publish(self._dep_id)
+
+        if self._index is not None:
+            self._index.add(deposition)
 
         print("Upload published")
 
-    def upload(self):
-        """process files for upload"""
+    async def _upload_all(self, file_list):
+        """upload every file, up to self._jobs at a time - collect the errors
+        rather than stopping at the first so all failures are reported. The
+        next file is only taken from file_list (on a worker thread, as it may
+        be packing archives) when there is a free slot to upload it."""
+
+        errors = {}
+        slots = asyncio.Semaphore(self._jobs)
+        files = iter(file_list)
+        end = object()
+
+        async def upload(filename):
+            try:
+                await self._upload(filename)
+            except Exception as e:
+                errors[upload_name(filename)] = e
+                # free the space of a failed archive now, else packing the
+                # next may wait for it forever - it is packed again to resume
+                if self._done is not None:
+                    self._done(filename)
+            finally:
+                slots.release()
+
+        tasks = []
+        try:
+            while True:
+                await slots.acquire()
+                filename = await self._api.run(next, files, end)
+                if filename is end:
+                    break
+                tasks.append(asyncio.ensure_future(upload(filename)))
+        finally:
+            # if taking the next file failed (e.g. packing) let the uploads
+            # under way finish, rather than leave them running behind the error
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if errors:
+            for filename in sorted(errors):
+                print("Upload failed: %s (%s)" % (filename, errors[filename]))
+            raise RuntimeError(
+                "in upload: %d of %d files failed" % (len(errors), len(tasks))
+            )
 
-        # FIXME wrap this in a try except
+    def _pending(self):
+        """files still to upload - all of them, unless resuming"""
 
-        self._create()
-        self._update()
         for filename in self._file_list:
-            self._upload(filename)
-        self._publish()
+            if self._bucket_files and self._uploaded(filename):
+                print("Already uploaded: %s" % upload_name(filename))
+                if self._done is not None:
+                    self._done(filename)
+            else:
+                yield filename
+
+    async def upload_async(self):
+        """process files for upload - with a journal, carry on with the draft
+        from an earlier interrupted upload if there is one"""
+
+        # FIXME wrap this in a try except
+
+        metrics = self._metrics
+        async with AsyncZenodoClient(self._client, self._jobs + 2) as self._api:
+            # before we do anything, check to see if it exists
+            with metrics.phase("find"):
+                await self._find()
+            if self._journal is not None and self._journal.deposition():
+                with metrics.phase("resume"):
+                    await self._resume()
+            else:
+                with metrics.phase("create"):
+                    await self._create()
+            with metrics.phase("update"):
+                await self._update()
+            await self._upload_all(self._pending())
+            with metrics.phase("publish"):
+                await self._publish()
+
+        if self._journal is not None:
+            self._journal.finish()
 
         # and in the except, delete the partial upload as it is broken
-        # - particularly to catch Ctrl-C
+        # - particularly to catch Ctrl-C - unless journaled, in which case
+        # the draft is kept for the next attempt to resume
+
+    def upload(self):
+        """upload_async, for callers outside an event loop"""
+
+        asyncio.run(self.upload_async())
 
     def get_deposition(self):
         return "%s/deposit/%s" % (self._server, self._dep_id)
 
 
+def split_metadata(metadata, directory=None, files=None, archive=None):
+    """take directory, files and archive out of metadata (read from a file)
+    unless already given, return (directory, files, archive)"""
+
+    if not directory and "directory" in metadata:
+        directory = metadata["directory"]
+    if not files and "files" in metadata:
+        files = metadata["files"]
+    if not archive and "archive" in metadata:
+        archive = metadata["archive"]
+
+    for key in ("directory", "files", "archive"):
+        metadata.pop(key, None)
+
+    return directory, files, archive
+
+
+def check_upload(directory, files, archive):
+    """validate the combination of directories, files and archives to upload,
+    raise ValueError if this makes no sense"""
+
+    # must pass some files, only pass files _or_ directories
+    if not directory and not files:
+        raise ValueError("must pass some files for upload")
+    if directory and files:
+        raise ValueError("only pass files or directories")
+
+    if archive:
+        if files and len(archive) != 1:
+            raise ValueError(
+                "if passing individual files and archive, only one archive allowed"
+            )
+        if directory and len(directory) != len(archive):
+            raise ValueError("number of archives must equal number of directories")
+
+        check_archive_names(archive)
+
+
+def check_archive_names(archive):
+    """check that we can guess what format to use for archives"""
+
+    for name in archive:
+        if not name.endswith(".zip") and not name.endswith(".tar.gz"):
+            raise ValueError("unknown archive type for %s" % name)
+
+
+def iter_uploads(
+    directory,
+    files,
+    archive,
+    pack=packup,
+    scan=scan_files,
+    pipeline=None,
+    archives=None,
+):
+    """yield the things to upload - files, or the archives made from them with
+    pack(archive_name, files) - the files in each directory are found with
+    scan(directory), unless archives gives the (archive_name, files) pairs
+    e.g. from plan_uploads. With pipeline (e.g. pack_pipeline), the archives
+    are made by pipeline(archives, pack) instead, and yielded as each is
+    packed. Raise ValueError if two uploads have the same name, as the
+    deposition has no directories to tell them apart."""
+
+    def uploads():
+        if archive or archives:
+            if archives:
+                pairs = archives
+            elif files:
+                pairs = [(archive[0], files)]
+            else:
+                pairs = (
+                    (name, list(scan(path))) for name, path in zip(archive, directory)
+                )
+            if pipeline is None:
+                for name, contents in pairs:
+                    yield pack(name, contents)
+            else:
+                yield from pipeline(pairs, pack)
+        elif directory:
+            for path in directory:
+                yield from scan(path)
+        else:
+            yield from files
+
+    keys = {}
+    for upload in uploads():
+        key = upload_key(upload)
+        if key in keys:
+            raise ValueError(
+                "%s and %s would both be uploaded as %s"
+                % (upload_name(keys[key]), upload_name(upload), key)
+            )
+        keys[key] = upload
+        yield upload
+
+
+def list_uploads(
+    directory,
+    files,
+    archive,
+    pack=packup,
+    scan=scan_files,
+    pipeline=None,
+    archives=None,
+):
+    """list of everything to upload, from iter_uploads"""
+
+    return list(iter_uploads(directory, files, archive, pack, scan, pipeline, archives))
+
+
+def parse_size(text):
+    """size in bytes from e.g. 500M or 50G (powers of 1000) or a number"""
+
+    units = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+    text = text.strip().upper().rstrip("B")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %s" % text)
+
+
+def add_upload_arguments(parser):
+    """add the options for how files are found, packed and uploaded (shared by
+    zenodo_uploader.py, zenodo_batch.py and zenodo_daemon.py) to parser"""
+
+    # finding files
+    parser.add_argument(
+        "-r",
+        "--recursive",
+        help="include files in subdirectories of each directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--include",
+        help="only upload files from directories matching glob e.g. '*.cbf'",
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="skip files and subdirectories matching glob",
+        action="append",
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        help="number of threads to read directories with",
+        type=int,
+        default=1,
+    )
+
+    # packing archives
+    parser.add_argument(
+        "--compression-level",
+        help="compression level for archives, 0 (none) to 9 (best)",
+        type=int,
+        choices=range(10),
+        metavar="LEVEL",
+    )
+    parser.add_argument(
+        "--always-compress",
+        help="deflate every zip member, even those which will not compress",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pack-jobs",
+        help="number of threads to compress archives with",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--stream",
+        help="build archives while uploading, without a temporary file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard-size",
+        help="split archives into numbered shards of at most this size e.g. 20G",
+        type=parse_size,
+    )
+    parser.add_argument(
+        "--shard-files",
+        help="split archives into numbered shards of at most this many files",
+        type=int,
+    )
+    parser.add_argument(
+        "--archive-jobs",
+        help="number of archives (or shards) to pack at once, ahead of "
+        "uploading them (default 2)",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--scratch-limit",
+        help="most temporary disk space packed archives may take at once e.g. 100G",
+        type=parse_size,
+    )
+
+    # uploading
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of files to upload concurrently",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-x",
+        "--checksum",
+        help="verify md5 checksum of uploaded files against Zenodo",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        help="SQLite file to cache checksums of unchanged files in",
+    )
+    parser.add_argument(
+        "--rate", help="maximum API requests per second to make", type=float
+    )
+    parser.add_argument(
+        "--retries",
+        help="times to retry rate limited or failed requests (default 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--index",
+        help="file to cache an index of the account's depositions in, for "
+        "title lookups",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="write time, bytes and throughput of each phase to file",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        help="JSON lines as each phase completes, or a Prometheus textfile of "
+        "totals at the end (default json)",
+        choices=METRICS_FORMATS,
+        default="json",
+    )
+    parser.add_argument(
+        "--progress",
+        help="show bytes sent and transfer rate while uploading",
+        action="store_true",
+    )
+
+
+def check_upload_arguments(args):
+    """exit with a message if the options from add_upload_arguments are wrong"""
+
+    if args.jobs < 1:
+        sys.exit("number of upload jobs must be at least 1")
+
+    if args.pack_jobs < 1:
+        sys.exit("number of packing jobs must be at least 1")
+
+    if args.scan_jobs < 1:
+        sys.exit("number of scanning jobs must be at least 1")
+
+    if args.archive_jobs < 1:
+        sys.exit("number of archive jobs must be at least 1")
+
+
+def scanner(args):
+    """scan_files, finding files as the options from add_upload_arguments say"""
+
+    return functools.partial(
+        scan_files,
+        recursive=args.recursive,
+        include=args.include or (),
+        exclude=args.exclude or (),
+        jobs=args.scan_jobs,
+    )
+
+
+def upload_setup(args, pool_size):
+    """make what every deposition shares from the options of
+    add_upload_arguments, reading the access token if not given - return the
+    client, the metrics and the keyword arguments for deposit() i.e. pack,
+    scan, pipeline and those for ZenodoUploader"""
+
+    if not args.zenodo_id:
+        args.zenodo_id = get_access_token(sandbox=args.sandbox)
+
+    metrics = Metrics(args.metrics, args.metrics_format, progress=args.progress)
+
+    # with --stream the archives are only built as they are uploaded
+    if args.stream:
+        pack = ArchiveStream
+    else:
+        pack = functools.partial(packup, metrics=metrics)
+    pack = functools.partial(
+        pack,
+        level=args.compression_level,
+        jobs=args.pack_jobs,
+        adaptive=not args.always_compress,
+    )
+
+    # archives are packed in the background, each uploaded as soon as it is
+    # ready and then removed, with one limit on the scratch disk they take
+    scratch = ScratchSpace(args.scratch_limit)
+    pipeline = functools.partial(
+        pack_pipeline,
+        jobs=args.archive_jobs,
+        scratch=scratch,
+        max_size=args.shard_size,
+        max_files=args.shard_files,
+    )
+
+    client = ZenodoClient(
+        args.zenodo_id,
+        sandbox=args.sandbox,
+        pool_size=pool_size,
+        rate=args.rate,
+        retries=args.retries,
+    )
+
+    # one index of existing depositions rather than a search per deposition
+    if args.index:
+        index = DepositionIndex(client, args.index)
+    else:
+        index = None
+
+    kwargs = dict(
+        pack=pack,
+        scan=scanner(args),
+        pipeline=pipeline,
+        jobs=args.jobs,
+        checksum=args.checksum,
+        cache=args.hash_cache and HashCache(args.hash_cache),
+        index=index,
+        metrics=metrics,
+        done=scratch.remove,
+    )
+    return client, metrics, kwargs
+
+
 def uploader():
     """main() - parse args, make Zenodo uploader, execute, catch errors"""
 
@@ -186,10 +694,15 @@ def uploader():
     )
     parser.add_argument("files", nargs="*", help="individual files")
     parser.add_argument(
-        "-x",
-        "--checksum",
-        help="compute md5 checksum of uploaded files",
-        action="store_true",
+        "-H",
+        "--hash",
+        help="list checksums of files with algorithm before upload",
+        choices=CHECKSUM_ALGORITHMS,
+    )
+    parser.add_argument(
+        "--hash-jobs",
+        help="number of processes to checksum with (default: one per CPU)",
+        type=int,
     )
 
     # what we are doing with the files
@@ -199,6 +712,57 @@ def uploader():
         help="pack directory to named archive before upload",
         action="append",
     )
+    parser.add_argument(
+        "--plan",
+        help="bin-pack the files into as few archives (named from -a, if "
+        "given) and depositions as fit the limits, show the plan and upload it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan-only",
+        help="show the plan, and stop before packing or uploading anything",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--archive-size",
+        help="with --plan, largest archive to make e.g. 20G",
+        type=parse_size,
+    )
+    parser.add_argument(
+        "--archive-files",
+        help="with --plan, most files to put in one archive",
+        type=int,
+    )
+    parser.add_argument(
+        "--deposition-size",
+        help="with --plan, most bytes in one deposition (default 50G)",
+        type=parse_size,
+        default=ZENODO_MAX_SIZE,
+    )
+    parser.add_argument(
+        "--deposition-files",
+        help="with --plan, most files in one deposition (default %d)"
+        % ZENODO_MAX_FILES,
+        type=int,
+        default=ZENODO_MAX_FILES,
+    )
+    parser.add_argument(
+        "--bandwidth",
+        help="upload rate to estimate the transfer time with, bytes / second "
+        "e.g. 100M (default 50M)",
+        type=parse_size,
+        default=50 * 1000**2,
+    )
+    parser.add_argument(
+        "--pool-size",
+        help="number of HTTP connections to keep open (default: max(10, jobs))",
+        type=int,
+    )
+    parser.add_argument(
+        "--journal",
+        help="record progress in file, resume from it if upload was interrupted",
+    )
+    add_upload_arguments(parser)
     args = parser.parse_args()
 
     # validate metadata - allow file read and update from command line
@@ -209,40 +773,55 @@ def uploader():
         metadata = {}
 
     # pull files or directory (&c.) from metadata file if that is where they are
-    if not args.directory and "directory" in metadata:
-        args.directory = metadata["directory"]
-        del metadata["directory"]
-
-    if not args.files and "files" in metadata:
-        args.files = metadata["files"]
-        del metadata["files"]
-
-    if not args.archive and "archive" in metadata:
-        args.archive = metadata["archive"]
-        del metadata["archive"]
-
-    # validate inputs - must pass some files, only pass files _or_ directories
-    if not args.directory and not args.files:
-        sys.exit("must pass some files for upload")
-    if args.directory and args.files:
-        sys.exit("only pass files or directories")
-
-    if args.archive:
-        if args.files and len(args.archive) != 1:
-            sys.exit(
-                "if passing individual files and archive, only one archive allowed"
-            )
-        if args.directory and len(args.directory) != len(args.archive):
-            sys.exit("number of archives must equal number of directories")
+    args.directory, args.files, args.archive = split_metadata(
+        metadata, args.directory, args.files, args.archive
+    )
 
-    # check that we can guess what format to use for archives
-    if args.archive:
-        for archive in args.archive:
-            if not archive.endswith(".zip") and not archive.endswith(".tar.gz"):
-                sys.exit("unknown archive type for %s" % archive)
+    if args.plan_only:
+        args.plan = True
 
-    if not args.zenodo_id:
-        args.zenodo_id = get_access_token(sandbox=args.sandbox)
+    try:
+        if args.plan:
+            # one archive name at most, to number the planned archives from
+            check_upload(args.directory, args.files, None)
+            if args.archive and len(args.archive) > 1:
+                raise ValueError("with --plan, give at most one archive name")
+            check_archive_names(args.archive or ())
+        else:
+            check_upload(args.directory, args.files, args.archive)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.plan and (args.shard_size or args.shard_files):
+        sys.exit("with --plan, limit archives with --archive-size / --archive-files")
+
+    if (args.archive_size or args.archive_files) and not (args.plan and args.archive):
+        sys.exit("--archive-size and --archive-files only apply to planned archives")
+
+    if args.stream and not args.archive:
+        sys.exit("--stream only applies when packing archives")
+
+    check_upload_arguments(args)
+
+    if (args.shard_size or args.shard_files) and not args.archive:
+        sys.exit("--shard-size and --shard-files only apply when packing archives")
+
+    if args.scratch_limit and args.hash:
+        sys.exit("--hash needs every archive packed at once, so no --scratch-limit")
+
+    # with --plan, decide the archives and depositions before anything else
+    if args.plan:
+        plan = plan_uploads(
+            plan_files(args.directory, args.files, scanner(args)),
+            args.archive and args.archive[0],
+            max_archive_size=args.archive_size,
+            max_archive_files=args.archive_files,
+            max_deposition_size=args.deposition_size,
+            max_deposition_files=args.deposition_files,
+        )
+        print_plan(plan, args.bandwidth)
+        if args.plan_only:
+            return
 
     cl_metadata = make_metadata(
         args.title, args.description, args.creator, args.affiliation, args.keyword
@@ -251,50 +830,103 @@ def uploader():
     metadata.update(cl_metadata)
     validate_metadata(metadata)
 
+    # make the client, and how archives are packed - archives are uploaded
+    # as they are packed unless they are to be listed with checksums first,
+    # in which case they must all be packed up front
+    client, metrics, kwargs = upload_setup(
+        args, pool_size=args.pool_size or max(10, args.jobs)
+    )
+    pack = kwargs.pop("pack")
+    scan = kwargs.pop("scan")
+    pipeline = kwargs.pop("pipeline")
+    pipelined = args.archive and not args.hash
+
     # explain what we are going to do
     print("ID: %s" % args.zenodo_id)
 
-    # prepare archives / files for upload
-    uploads = []
-
-    if args.archive:
-        if args.files:
-            uploads.append(packup(args.archive[0], args.files))
-        else:
-            for archive, directory in zip(args.archive, args.directory):
-                files = [
-                    os.path.join(directory, filename)
-                    for filename in os.listdir(directory)
-                    if os.path.isfile(os.path.join(directory, filename))
-                ]
-                uploads.append(packup(archive, files))
-
-    elif args.directory:
-        for directory in args.directory:
-            uploads.extend(
-                [
-                    os.path.join(directory, filename)
-                    for filename in os.listdir(directory)
-                    if os.path.isfile(os.path.join(directory, filename))
-                ]
-            )
+    # each deposition to make - metadata, uploads (directory, files, archive,
+    # archives as for iter_uploads) and journal
+    if not args.plan:
+        parts = [
+            (metadata, (args.directory, args.files, args.archive, None), args.journal)
+        ]
     else:
-        uploads.extend(args.files)
-
-    # metadata
-    print_metadata(metadata)
-
-    # files
-    print("Upload consists of:")
-    for upload in uploads:
-        print(upload)
-        if args.checksum:
-            print("md5:%s" % md5(upload))
-
-    # make and act on
-    zenodo_uploader = ZenodoUploader(uploads, metadata, args.zenodo_id, args.sandbox)
-    zenodo_uploader.upload()
-    print("Upload complete for deposition %s" % str(zenodo_uploader.get_deposition()))
+        parts = []
+        for j, deposition in enumerate(plan):
+            part = dict(metadata)
+            journal = args.journal
+            if len(plan) > 1:
+                part["title"] = "%s (part %d of %d)" % (
+                    metadata["title"],
+                    j + 1,
+                    len(plan),
+                )
+                journal = journal and "%s.%d" % (journal, j + 1)
+            if args.archive:
+                uploads = (None, None, None, deposition)
+            else:
+                uploads = (None, [files[0] for name, files in deposition], None, None)
+            parts.append((part, uploads, journal))
+
+    depositions = []
+    try:
+        for part, (directory, files, archive, archives), journal in parts:
+            if pipelined:
+                uploads = iter_uploads(
+                    directory, files, archive, pack, scan, pipeline, archives
+                )
+            else:
+                try:
+                    uploads = list_uploads(
+                        directory, files, archive, pack, scan, pipeline, archives
+                    )
+                except ValueError as e:
+                    sys.exit(str(e))
+
+            # metadata
+            print_metadata(part)
+
+            if args.hash:
+                digests = checksums(
+                    [u for u in uploads if not isinstance(u, ArchiveStream)],
+                    args.hash,
+                    jobs=args.hash_jobs,
+                    cache=kwargs["cache"],
+                    metrics=metrics,
+                )
+            else:
+                digests = {}
+
+            if pipelined:
+                names = archive or [name for name, contents in archives]
+                print("Upload consists of: %s (packed during upload)" % " ".join(names))
+            else:
+                print("Upload consists of:")
+                for upload in uploads:
+                    print(upload_name(upload))
+                    if upload_name(upload) in digests:
+                        print("%s:%s" % (args.hash, digests[upload_name(upload)]))
+
+            zenodo_uploader = ZenodoUploader(
+                uploads,
+                part,
+                args.zenodo_id,
+                args.sandbox,
+                client=client,
+                journal=journal and UploadJournal(journal),
+                **kwargs
+            )
+            zenodo_uploader.upload()
+            depositions.append(zenodo_uploader.get_deposition())
+    finally:
+        # record the metrics of failed uploads too
+        metrics.close(client.counters())
+    if kwargs["index"] is not None:
+        kwargs["index"].save()
+    metrics.report()
+    client.report()
+    for deposition in depositions:
+        print("Upload complete for deposition %s" % str(deposition))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+#!/usr/bin/env dials.python
+
+import argparse
+import asyncio
+import functools
+import json
+import sys
+
+from deposition_index import DepositionIndex
+from file_packing import checksums
+from file_scanning import scan_files
+from hash_cache import HashCache
+from metadata import read_metadata
+from zenodo_async import AsyncZenodoClient
+from zenodo_batch import list_metadata_files
+from zenodo_client import ZenodoClient, get_access_token
+from zenodo_updater import find_deposition
+from zenodo_uploader import split_metadata, upload_key
+
+
+def local_files(metadata_file, scan=scan_files):
+    """(title, {upload key: local file}) for the deposition described by
+    metadata_file - None for the files if it was uploaded as archives,
+    which are made at upload so cannot be checked against the files"""
+
+    metadata = read_metadata(metadata_file)
+    directory, files, archive = split_metadata(metadata)
+    if archive:
+        return metadata["title"], None
+
+    found = list(files or ())
+    for path in directory or ():
+        found.extend(scan(path))
+    return metadata["title"], {upload_key(f): f for f in found}
+
+
+def compare(local, digests, remote):
+    """what differs between the local files (upload key: file, with md5
+    digests by file) and the files of a deposition - return a dictionary of
+    missing (here, not deposited), extra (deposited, not here) and
+    mismatched files"""
+
+    remote = {f["filename"]: f for f in remote}
+    return {
+        "missing": sorted(set(local) - set(remote)),
+        "extra": sorted(set(remote) - set(local)),
+        "mismatched": [
+            {
+                "file": local[key],
+                "local": digests[local[key]],
+                "remote": remote[key]["checksum"],
+            }
+            for key in sorted(set(local) & set(remote))
+            if digests[local[key]] != remote[key]["checksum"]
+        ],
+    }
+
+
+async def verify(
+    depositions, client, concurrency=8, hash_jobs=None, cache=None, index=None
+):
+    """check each deposition, given as (title, {upload key: file}), holds
+    exactly the local files - listings are fetched concurrency at a time
+    while the local md5s are computed across hash_jobs processes (or taken
+    from the HashCache cache). Return a list of results, one per deposition,
+    with the state ok, mismatch, skipped or error - e.g. if a local file
+    cannot be read."""
+
+    files = [f for title, local in depositions for f in (local or {}).values()]
+    errors = {}
+
+    async with AsyncZenodoClient(client, concurrency + 1) as api:
+        digests = asyncio.ensure_future(
+            api.run(checksums, files, "md5", jobs=hash_jobs, cache=cache, errors=errors)
+        )
+        slots = asyncio.Semaphore(concurrency)
+
+        async def check(title, local):
+            result = {"title": title, "deposition": None}
+            if local is None:
+                result["state"] = "skipped"
+                result["error"] = "uploaded as archives"
+                return result
+            try:
+                async with slots:
+                    deposition = await find_deposition(api, title, index)
+                    result["deposition"] = deposition["id"]
+                    remote = await api.list_files(deposition["id"])
+                local_digests = await digests
+            except Exception as e:
+                result["state"] = "error"
+                result["error"] = str(e)
+                return result
+            unreadable = sorted(f for f in local.values() if f in errors)
+            if unreadable:
+                result["state"] = "error"
+                result["error"] = "; ".join(str(errors[f]) for f in unreadable)
+                return result
+            result.update(compare(local, local_digests, remote))
+            if result["missing"] or result["extra"] or result["mismatched"]:
+                result["state"] = "mismatch"
+            else:
+                result["state"] = "ok"
+            return result
+
+        try:
+            return await asyncio.gather(
+                *[check(title, local) for title, local in depositions]
+            )
+        finally:
+            await asyncio.gather(digests, return_exceptions=True)
+
+
+def print_results(results):
+    for result in results:
+        if result["state"] == "ok":
+            continue
+        print("%s: %s" % (result["state"].capitalize(), result["title"]))
+        if result.get("error"):
+            print("  %s" % result["error"])
+        for key in result.get("missing", ()):
+            print("  not deposited: %s" % key)
+        for key in result.get("extra", ()):
+            print("  not here: %s" % key)
+        for mismatch in result.get("mismatched", ()):
+            print(
+                "  checksum differs: %s md5:%s, Zenodo has md5:%s"
+                % (mismatch["file"], mismatch["local"], mismatch["remote"])
+            )
+
+    counts = {}
+    for result in results:
+        counts[result["state"]] = counts.get(result["state"], 0) + 1
+    print(
+        "Verified %d depositions: %s"
+        % (
+            len(results),
+            ", ".join("%d %s" % (counts[state], state) for state in sorted(counts)),
+        )
+    )
+    return counts
+
+
+def verifier():
+    """main() - parse args, verify every deposition described by the metadata
+    files against the local files, report mismatches"""
+
+    parser = argparse.ArgumentParser()
+
+    # zenodo / administrative matters
+    parser.add_argument("-z", "--zenodo_id", help="zenodo upload key")
+    parser.add_argument("-s", "--sandbox", help="use sandbox mode", action="store_true")
+
+    parser.add_argument(
+        "metadata", nargs="*", help="json metadata files, or directories of them"
+    )
+    parser.add_argument(
+        "--manifest",
+        help="file listing metadata files one per line",
+        action="append",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="number of depositions to fetch file listings for at once",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "-r",
+        "--recursive",
+        help="include files in subdirectories of each directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--include",
+        help="only take files from directories matching glob e.g. '*.cbf'",
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="skip files and subdirectories matching glob",
+        action="append",
+    )
+    parser.add_argument(
+        "--hash-jobs",
+        help="number of processes to checksum with (default: one per CPU)",
+        type=int,
+    )
+    parser.add_argument(
+        "--hash-cache",
+        help="SQLite file to cache checksums of unchanged files in",
+    )
+    parser.add_argument(
+        "--index",
+        help="file to cache an index of the account's depositions in, for "
+        "title lookups",
+    )
+    parser.add_argument(
+        "--rate", help="maximum API requests per second to make", type=float
+    )
+    parser.add_argument(
+        "--retries",
+        help="times to retry rate limited or failed requests (default 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument("--report", help="json file to write the results to")
+    args = parser.parse_args()
+
+    if not args.metadata and not args.manifest:
+        sys.exit("must pass some metadata files or a manifest")
+    if args.concurrency < 1:
+        sys.exit("concurrency must be at least 1")
+
+    scan = functools.partial(
+        scan_files,
+        recursive=args.recursive,
+        include=args.include or (),
+        exclude=args.exclude or (),
+    )
+    depositions = [
+        local_files(metadata_file, scan)
+        for metadata_file in list_metadata_files(
+            args.metadata, args.manifest, exclude=(args.index, args.report)
+        )
+    ]
+
+    if not args.zenodo_id:
+        args.zenodo_id = get_access_token(sandbox=args.sandbox)
+
+    client = ZenodoClient(
+        args.zenodo_id,
+        sandbox=args.sandbox,
+        pool_size=max(10, args.concurrency),
+        rate=args.rate,
+        retries=args.retries,
+    )
+    if args.index:
+        index = DepositionIndex(client, args.index)
+    else:
+        index = None
+
+    results = asyncio.run(
+        verify(
+            depositions,
+            client,
+            concurrency=args.concurrency,
+            hash_jobs=args.hash_jobs,
+            cache=args.hash_cache and HashCache(args.hash_cache),
+            index=index,
+        )
+    )
+
+    if index is not None:
+        index.save()
+    client.report()
+    counts = print_results(results)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if counts.get("mismatch") or counts.get("error"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    verifier()